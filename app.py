@@ -3,24 +3,52 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 from supabase import create_client
+from data_sources import create_data_source
 from datetime import datetime, timedelta
 import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 import os
+import sys
 import socket
+import threading
+import time
+import logging
+import json
+import re
+import html
+import shutil
+from collections import OrderedDict
+from types import MappingProxyType
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # =============================================================================
 # ПОДГРУЖАЕМ СТИЛИ
 # =============================================================================
+@st.cache_data
+def read_css(path):
+    """Читает файл стилей один раз, а не на каждом перезапуске"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
 def load_css():
     try:
-        with open('assets/style.css', 'r', encoding='utf-8') as f:
-            css = f.read()
-            st.markdown(f'<style>{css}</style>', unsafe_allow_html=True)
+        css = read_css('assets/style.css')
+        st.markdown(f'<style>{css}</style>', unsafe_allow_html=True)
     except FileNotFoundError:
         # Fallback стили
         st.markdown("""
@@ -166,114 +194,1694 @@ st.set_page_config(
 )
 
 # =============================================================================
-# ПОДКЛЮЧЕНИЕ К SUPABASE
+# ЗАМЕРЫ ПРОИЗВОДИТЕЛЬНОСТИ
 # =============================================================================
+# Время и число строк по этапам: загрузка, подготовка фактов, построение и
+# отрисовка графиков, попадания в кэши. Включается PERF_DEBUG=1 или параметром
+# ?debug=1 в адресе: замеры видны в боковой панели и пишутся в лог JSON-строками.
+# Выключенный замер стоит одной проверки атрибута.
+PERF_DEBUG = os.getenv("PERF_DEBUG", "0") == "1"
+
+perf_logger = logging.getLogger(f"{__name__}.perf")
+
+# Замеры текущего перезапуска: у каждой сессии Streamlit свой поток
+_perf = threading.local()
+
 @st.cache_resource
+def get_perf_counters():
+    """Счётчики попаданий и промахов кэшей за время жизни процесса"""
+    return {'counts': {}, 'lock': threading.Lock()}
+
+def start_perf_session(enabled):
+    """Начинает (или отключает) сбор замеров для текущего перезапуска"""
+    _perf.records = [] if enabled else None
+    _perf.misses = set()
+
+def log_perf_event(event):
+    """Структурированная запись в лог"""
+    perf_logger.info(json.dumps(event, ensure_ascii=False, default=str))
+
+@contextmanager
+def timed(stage, **fields):
+    """Замеряет этап; в возвращаемый словарь можно дописать поля (строки, кэш)"""
+    if getattr(_perf, 'records', None) is None:
+        yield fields
+        return
+    
+    started = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        event = {'stage': stage, 'ms': round((time.perf_counter() - started) * 1000, 2), **fields}
+        _perf.records.append(event)
+        log_perf_event(event)
+
+def note_cache_miss(cache_name):
+    """Вызывается внутри кэшируемой функции: результат считается заново"""
+    misses = getattr(_perf, 'misses', None)
+    if misses is not None:
+        misses.add(cache_name)
+
+def cache_status(cache_name):
+    """'hit' или 'miss' для только что вызванной кэшируемой функции (с учётом в счётчиках)"""
+    misses = getattr(_perf, 'misses', set())
+    status = 'miss' if cache_name in misses else 'hit'
+    misses.discard(cache_name)
+    
+    counters = get_perf_counters()
+    with counters['lock']:
+        key = (cache_name, status)
+        counters['counts'][key] = counters['counts'].get(key, 0) + 1
+    return status
+
+# =============================================================================
+# ПОДКЛЮЧЕНИЕ К SUPABASE
+# =============================================================================
 def init_supabase():
+    return create_client(
+        supabase_url=os.getenv("SUPABASE_URL"),
+        supabase_key=os.getenv("SUPABASE_KEY")
+    )
+
+# Откуда брать таблицы: supabase (живая база), csv (живая база, ответы в CSV
+# разбираются сразу в колонки), snapshot (локальные parquet/json),
+# record (живая база с записью ответов) или replay (воспроизведение записи).
+# DATA_SOURCE_LATENCY_MS добавляет задержку к каждому запросу локальных источников
+DATA_SOURCE = os.getenv("DATA_SOURCE", "supabase")
+DATA_SOURCE_PATH = os.getenv("DATA_SOURCE_PATH", "data")
+DATA_SOURCE_LATENCY_MS = float(os.getenv("DATA_SOURCE_LATENCY_MS", "0"))
+
+def new_data_source():
+    """Источник данных по настройкам окружения (общий для дашборда и отчётов)"""
+    return create_data_source(
+        DATA_SOURCE, DATA_SOURCE_PATH, DATA_SOURCE_LATENCY_MS, client_factory=init_supabase,
+        url=os.getenv("SUPABASE_URL"), key=os.getenv("SUPABASE_KEY"), column_types=arrow_column_types()
+    )
+
+@st.cache_resource
+def init_data_source():
     try:
-        client = create_client(
-            supabase_url=os.getenv("SUPABASE_URL"),
-            supabase_key=os.getenv("SUPABASE_KEY")
-        )
-        return client
+        return new_data_source()
     except Exception as e:
         st.error(f"Ошибка подключения к базе данных: {e}")
         return None
 
-@st.cache_data(ttl=300)
-def load_real_data(_supabase):
-    """Загружает реальные данные из базы"""
+# Инкрементальная синхронизация: для каждой таблицы храним "водяной знак"
+# (максимальное значение монотонной колонки) и догружаем только строки после него.
+# key - колонка, по которой новая версия строки заменяет старую.
+#
+# В известной нам схеме таблиц нет колонок времени изменения, поэтому водяной
+# знак по умолчанию - id: дельта приносит только новые строки, а правки старых
+# (ученик сменил класс, исправленная оценка) видны только после полной
+# перезагрузки раз в FULL_SYNC_INTERVAL. Если в базе есть updated_at (или
+# created_at у таблиц, куда строки только добавляются), её можно сделать водяным
+# знаком: SYNC_WATERMARKS="users:updated_at,meal_ratings:updated_at" - тогда
+# дельта приносит и изменённые строки.
+SYNC_TABLES = {
+    'surveys': {'key': 'id', 'watermark': 'id'},
+    'users': {'key': 'telegram_id', 'watermark': 'id'},
+    'meal_ratings': {'key': 'id', 'watermark': 'id'},
+    'meal_comments': {'key': 'id', 'watermark': 'id'},
+}
+
+def parse_watermarks(value):
+    """'таблица:колонка,...' -> {таблица: колонка}"""
+    watermarks = {}
+    for item in value.split(','):
+        if item.strip():
+            table, column = (part.strip() for part in item.split(':', 1))
+            if table not in SYNC_TABLES:
+                raise ValueError(f"SYNC_WATERMARKS: неизвестная таблица {table}")
+            watermarks[table] = column
+    return watermarks
+
+for _table, _column in parse_watermarks(os.getenv("SYNC_WATERMARKS", "")).items():
+    SYNC_TABLES[_table]['watermark'] = _column
+
+# Схема таблиц: загружаем только нужные дашборду колонки и сразу приводим их
+# к компактным типам, чтобы не разбирать даты и числа заново на каждом перезапуске
+TABLE_SCHEMAS = {
+    'surveys': {
+        'id': 'int64',
+        'telegram_id': 'int64',
+        'date': 'datetime64[ns]',
+        'overall_satisfaction': 'int8',
+        'eats_at_school': 'bool'
+    },
+    'users': {
+        'id': 'int64',
+        'telegram_id': 'int64',
+        'class': 'category'
+    },
+    'meal_ratings': {
+        'id': 'int64',
+        'survey_id': 'int64',
+        'meal_type': 'category',
+        'rating': 'int8'
+    },
+    'meal_comments': {
+        'id': 'int64',
+        'survey_id': 'int64',
+        'meal_type': 'category',
+        'comment': 'string'
+    }
+}
+
+def arrow_column_types():
+    """Схема таблиц в типах pyarrow: в них колоночный источник разбирает CSV"""
+    def arrow_type(dtype):
+        if dtype in ('category', 'string'):
+            # Словарь на каждой странице: повторяющиеся строки не копируются
+            return pa.dictionary(pa.int32(), pa.string()) if dtype == 'category' else pa.string()
+        return pa.from_numpy_dtype(np.dtype(dtype))
+    return {
+        table: {column: arrow_type(dtype) for column, dtype in schema.items()}
+        for table, schema in TABLE_SCHEMAS.items()
+    }
+
+# Колонка времени изменения, ставшая водяным знаком, загружается как есть - строкой
+# ISO от PostgREST: строки одного формата сравниваются в порядке времени
+for _table, _config in SYNC_TABLES.items():
+    TABLE_SCHEMAS[_table].setdefault(_config['watermark'], 'string')
+
+def cast_column(series, dtype):
+    """Приводит колонку к типу схемы (с пропусками - к nullable-варианту)"""
+    if dtype.startswith('datetime64'):
+        # Единица времени у источников разная (CSV даёт ns, JSON - us) - приводим к схеме
+        if not pd.api.types.is_datetime64_any_dtype(series):
+            series = pd.to_datetime(series)
+        return series if series.dtype == dtype else series.astype(dtype)
+    if str(series.dtype) == dtype:
+        return series
+    if dtype in ('int8', 'int64'):
+        series = pd.to_numeric(series)
+        return series.astype(dtype.capitalize() if series.isna().any() else dtype)
+    if dtype == 'bool':
+        return series.astype('boolean' if series.isna().any() else 'bool')
+    return series.astype(dtype)
+
+def apply_schema(df, table):
+    """Оставляет колонки схемы и приводит их к объявленным типам"""
+    schema = TABLE_SCHEMAS[table]
+    if df.empty and len(df.columns) == 0:
+        # Пустой ответ без колонок - возвращаем пустую таблицу нужной формы
+        return pd.DataFrame({
+            column: pd.Series(dtype=dtype) for column, dtype in schema.items()
+        })
+    
+    columns = [column for column in schema if column in df.columns]
+    df = df[columns]
+    return df.assign(**{column: cast_column(df[column], schema[column]) for column in columns})
+
+# Периодическая полная перезагрузка подхватывает правки и удаления старых строк
+FULL_SYNC_INTERVAL = int(os.getenv("FULL_SYNC_INTERVAL", "3600"))
+
+def new_sync_state(school=None):
+    """Общее для всех сессий школы состояние синхронизации: таблицы и водяные знаки.
+    
+    dataset - опубликованная версия, которую видят сессии; frames - последние
+    загруженные таблицы (могут опережать dataset, пока новая версия готовится).
+    При старте процесса поднимается из последнего снимка на диске, если он есть.
+    """
+    state = {
+        'school': school,
+        'frames': {},
+        'watermarks': {},
+        'version': 0,
+        # Версия, в которой изменились или исчезли уже загруженные строки: производным
+        # данным, которые дополняются только новыми строками, нужно пересчитаться заново
+        'rewritten_version': 0,
+        'last_full_sync': 0.0,
+        'load_stats': {},
+        # Кубы из снимка для его версии - забираются первым get_facts
+        'snapshot_cubes': None,
+        'dataset': None,
+        'refreshed_at': None,
+        'checked_at': None,
+        'refresh_seconds': None,
+        'refresh_error': None,
+        'refresh_thread': None,
+        'lock': threading.Lock(),
+        'sync_lock': threading.Lock()
+    }
+    
+    snapshot = load_snapshot(school)
+    if snapshot:
+        state.update(snapshot)
+        state['dataset'] = make_dataset(state)
+    
+    return state
+
+# Постраничная загрузка: PostgREST по умолчанию отдаёт не больше 1000 строк за запрос
+PAGE_SIZE = int(os.getenv("SUPABASE_PAGE_SIZE", "1000"))
+MAX_WORKERS = int(os.getenv("SUPABASE_MAX_WORKERS", "8"))
+
+def fetch_page(_source, table, watermark_column, since, start, end, with_count=False, tenant=None):
+    """Загружает одну страницу таблицы (строки с start по end включительно)"""
+    return _source.fetch_page(
+        table, list(TABLE_SCHEMAS[table]), watermark_column, since, start, end, with_count, tenant
+    )
+
+def pages_to_frame(pages):
+    """Страницы таблицы -> DataFrame.
+    
+    Колоночный источник отдаёт страницы как pyarrow.Table - они склеиваются
+    без прохода по строкам; остальные источники - списки словарей.
+    """
+    if pages and all(isinstance(page, pa.Table) for page in pages):
+        return pa.concat_tables(pages, promote_options='permissive').to_pandas()
+    return pd.DataFrame([row for page in pages for row in page])
+
+def fetch_remaining_pages(_source, table, since, start, page_size, tenant=None):
+    """Дочитывает таблицу с неизвестным числом строк последовательно до короткой страницы"""
+    pages = []
+    while True:
+        rows, _ = fetch_page(_source, table, SYNC_TABLES[table]['watermark'], since,
+                             start, start + page_size - 1, False, tenant)
+        pages.append((start, rows))
+        start += len(rows)
+        if len(rows) != page_size:
+            return pages
+
+def fetch_tables(_source, since_by_table, school=None):
+    """Параллельно загружает все страницы всех таблиц (только строки школы, если она задана).
+    
+    since_by_table: {таблица: водяной знак или None для полной загрузки}
+    Возвращает ({таблица: DataFrame}, {таблица: {'rows', 'pages', 'seconds'}})
+    """
+    pages_by_table = {table: [] for table in since_by_table}
+    stats = {}
+    
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Первая страница каждой таблицы заодно сообщает общее число строк.
+        # pending: {future: (таблица, номер первой строки или None для дочитывания)}
+        pending = {}
+        for table, since in since_by_table.items():
+            stats[table] = {'started': time.perf_counter(), 'finished': None, 'pages': 1}
+            future = executor.submit(
+                fetch_page, _source, table, SYNC_TABLES[table]['watermark'],
+                since, 0, PAGE_SIZE - 1, True, tenant_filter(table, school)
+            )
+            pending[future] = (table, 0)
+        
+        # Остальные страницы таблицы ставятся в очередь, как только пришла её
+        # первая страница, - не дожидаясь первых страниц других таблиц
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                table, start = pending.pop(future)
+                stats[table]['finished'] = time.perf_counter()
+                if start is None:
+                    pages_by_table[table].extend(future.result())
+                    stats[table]['pages'] += len(future.result())
+                    continue
+                
+                rows, total = future.result()
+                pages_by_table[table].append((start, rows))
+                if start > 0:
+                    continue
+                
+                # Сервер может резать страницу сильнее, чем мы просили
+                page_size = len(rows) if 0 < len(rows) < PAGE_SIZE else PAGE_SIZE
+                since = since_by_table[table]
+                tenant = tenant_filter(table, school)
+                if total is None:
+                    # Число строк неизвестно - эта таблица дочитывается последовательно
+                    # в одном потоке, остальные продолжают загружаться параллельно
+                    if len(rows) == page_size:
+                        rest = executor.submit(
+                            fetch_remaining_pages, _source, table, since, len(rows), page_size, tenant
+                        )
+                        pending[rest] = (table, None)
+                    continue
+                
+                for page_start in range(len(rows), total, page_size):
+                    page = executor.submit(
+                        fetch_page, _source, table, SYNC_TABLES[table]['watermark'],
+                        since, page_start, page_start + page_size - 1, False, tenant
+                    )
+                    pending[page] = (table, page_start)
+                    stats[table]['pages'] += 1
+    
+    rows_by_table = {
+        table: [rows for _, rows in sorted(pages, key=lambda page: page[0])]
+        for table, pages in pages_by_table.items()
+    }
+    
+    frames = {}
+    for table, pages in rows_by_table.items():
+        frames[table] = apply_schema(pages_to_frame(pages), table)
+        stats[table] = {
+            'rows': len(frames[table]),
+            'pages': stats[table]['pages'],
+            'seconds': round(stats[table]['finished'] - stats[table]['started'], 3)
+        }
+        log_perf_event({'stage': 'fetch_table', 'table': table, **stats[table]})
+    
+    return frames, stats
+
+def get_watermark(df, column):
+    """Максимальное значение колонки-водяного знака (None, если данных нет)"""
+    if df.empty or column not in df.columns or df[column].isna().all():
+        return None
+    value = df[column].max()
+    return value.item() if hasattr(value, 'item') else value
+
+def merge_delta(current_df, delta_df, key):
+    """Вливает новые/изменённые строки в уже загруженную таблицу"""
+    if current_df is None or current_df.empty:
+        return delta_df
+    if delta_df.empty:
+        return current_df
+    
+    combined = pd.concat([current_df, delta_df], ignore_index=True)
+    if key in combined.columns:
+        combined = combined.drop_duplicates(subset=key, keep='last').reset_index(drop=True)
+    return combined
+
+def sync_tables(_source, state):
+    """Обновляет таблицы в состоянии: полная загрузка или только дельта.
+    
+    Сетевые запросы идут без блокировки чтения, поэтому сессии могут
+    читать прежнюю версию, пока загружается новая.
+    """
+    with state['sync_lock']:
+        now = time.time()
+        with state['lock']:
+            current_frames = dict(state['frames'])
+            full_sync = not current_frames or now - state['last_full_sync'] >= FULL_SYNC_INTERVAL
+            since_by_table = {
+                table: None if full_sync else state['watermarks'].get(table)
+                for table in SYNC_TABLES
+            }
+        
+        fetched, load_stats = fetch_tables(_source, since_by_table, state['school'])
+        
+        new_frames = {}
+        changed = False
+        rewritten = False
+        for table, config in SYNC_TABLES.items():
+            if since_by_table[table] is None:
+                # Полная загрузка (или таблица была пустой и водяного знака ещё нет).
+                # Те же данные - та же версия: кэши и снимок на диске остаются в силе
+                new_frames[table] = freeze_frame(fetched[table])
+                current = current_frames.get(table)
+                if current is not None and new_frames[table].equals(current):
+                    new_frames[table] = current
+                else:
+                    changed = True
+                    # Строки идут по водяному знаку: прежние строки - начало новой таблицы
+                    rewritten = rewritten or (
+                        current is not None
+                        and not new_frames[table].iloc[:len(current)].reset_index(drop=True).equals(current)
+                    )
+            elif not fetched[table].empty:
+                current = current_frames.get(table)
+                merged = merge_delta(current, fetched[table], config['key'])
+                # Дельта заменила строки с тем же ключом (например, ученик сменил класс)
+                rewritten = rewritten or (
+                    current is not None and len(merged) < len(current) + len(fetched[table])
+                )
+                # После склейки категории могут разойтись - восстанавливаем типы
+                new_frames[table] = freeze_frame(apply_schema(merged, table))
+                changed = True
+            else:
+                new_frames[table] = current_frames[table]
+        
+        with state['lock']:
+            state['frames'] = new_frames
+            state['watermarks'] = {
+                table: get_watermark(new_frames[table], config['watermark'])
+                for table, config in SYNC_TABLES.items()
+            }
+            state['load_stats'] = load_stats
+            if full_sync:
+                state['last_full_sync'] = now
+            if changed:
+                state['version'] += 1
+            if rewritten:
+                state['rewritten_version'] = state['version']
+            snapshot_args = (
+                new_frames, dict(state['watermarks']), state['version'], state['last_full_sync'], state['school']
+            )
+        
+        if changed:
+            save_snapshot(*snapshot_args)
+
+# Таблицы одной версии общие для всех сессий и не копируются при чтении.
+# Чтобы ни одна сессия не испортила их остальным, таблица - FrozenFrame: она не даёт
+# заменить, добавить или удалить колонку, переименовать строки и колонки, писать
+# через loc/iloc/at/iat и выполнять inplace-методы. Кроме того, буферы числовых,
+# булевых и категориальных колонок закрыты на запись: запись через .values или
+# to_numpy() падает с "assignment destination is read-only". Колонки, взятые из
+# таблицы (df['col']), pandas отдаёт с копированием при записи (copy-on-write).
+# Производные таблицы (срезы, фильтры, соединения, copy()) - обычные DataFrame
+class ReadOnlyIndexer:
+    """loc/iloc/at/iat общей таблицы: чтение как обычно, запись запрещена"""
+    def __init__(self, indexer):
+        self.indexer = indexer
+    
+    def __getitem__(self, key):
+        return self.indexer[key]
+    
+    def __setitem__(self, key, value):
+        raise ValueError(FrozenFrame.READ_ONLY_MESSAGE)
+    
+    def __getattr__(self, name):
+        return getattr(self.indexer, name)
+
+class FrozenFrame(pd.DataFrame):
+    """DataFrame, состав и значения которого нельзя изменить"""
+    READ_ONLY_MESSAGE = "Общая таблица версии данных только для чтения - изменяйте её копию (.copy())"
+    
+    @property
+    def _constructor(self):
+        return pd.DataFrame
+    
+    def __setitem__(self, key, value):
+        raise ValueError(self.READ_ONLY_MESSAGE)
+    
+    def __delitem__(self, key):
+        raise ValueError(self.READ_ONLY_MESSAGE)
+    
+    def insert(self, *args, **kwargs):
+        raise ValueError(self.READ_ONLY_MESSAGE)
+    
+    def pop(self, *args, **kwargs):
+        raise ValueError(self.READ_ONLY_MESSAGE)
+    
+    def _update_inplace(self, *args, **kwargs):
+        raise ValueError(self.READ_ONLY_MESSAGE)
+    
+    def _set_axis(self, *args, **kwargs):
+        # Замена подписей строк и колонок: df.columns = ..., rename(..., inplace=True)
+        raise ValueError(self.READ_ONLY_MESSAGE)
+    
+    @property
+    def loc(self):
+        return ReadOnlyIndexer(super().loc)
+    
+    @property
+    def iloc(self):
+        return ReadOnlyIndexer(super().iloc)
+    
+    @property
+    def at(self):
+        return ReadOnlyIndexer(super().at)
+    
+    @property
+    def iat(self):
+        return ReadOnlyIndexer(super().iat)
+
+def freeze_arrow_table(arrow_table):
+    """FrozenFrame поверх буферов Arrow без копирования, защищённый от записи.
+    
+    Числа и даты без пропусков становятся read-only представлениями буферов Arrow
+    (у снимка, открытого через memory_map, - прямо страниц файла). Булевы колонки
+    Arrow хранит по битам, а коды категорий с пропусками пересчитывает, поэтому
+    их закрываем на запись отдельно. Текстовые колонки остаются в Arrow как есть.
+    """
+    df = arrow_table.to_pandas(split_blocks=True)
+    for column in df.columns:
+        if df[column].dtype == bool:
+            values = df[column].to_numpy(copy=True)
+            values.flags.writeable = False
+            df[column] = pd.Series(values, index=df.index, copy=False)
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            codes = df[column].cat.codes.to_numpy(copy=True)
+            codes.flags.writeable = False
+            df[column] = pd.Series(
+                pd.Categorical.from_codes(codes, dtype=df[column].dtype), index=df.index, copy=False
+            )
+    return FrozenFrame(df)
+
+def freeze_frame(df):
+    """Неизменяемая версия таблицы для общего доступа"""
+    return freeze_arrow_table(pa.Table.from_pandas(df, preserve_index=False))
+
+def read_state_frames(state):
+    """Текущие таблицы (общие, только для чтения) и их версия"""
+    with state['lock']:
+        return dict(state['frames']), state['version']
+
+# =============================================================================
+# ШКОЛЫ
+# =============================================================================
+# Один процесс может обслуживать несколько школ. Школы перечисляются в SCHOOLS
+# ("64:Школа 64,12:Гимназия 12"), нужная выбирается параметром ?school= в адресе.
+# Таблицы каждой школы загружаются отдельно (фильтр по school_id на стороне базы)
+# и хранятся в своём разделе вместе с производными кэшами: фактами, статистиками
+# дней и индексом комментариев. Если все разделы вместе занимают больше
+# TENANT_MEMORY_MB, давно не открывавшиеся школы выгружаются из памяти - при
+# следующем открытии они поднимаются из своего снимка на диске.
+# Без SCHOOLS дашборд показывает одну школу и таблицы не фильтрует.
+DEFAULT_SCHOOL_NAME = "Школа 64"
+SCHOOL_COLUMN = os.getenv("SCHOOL_COLUMN", "school_id")
+TENANT_MEMORY_MB = float(os.getenv("TENANT_MEMORY_MB", "2048"))
+
+# Таблицы без колонки школы фильтруются через анкету, к которой относятся
+TENANT_PARENTS = {
+    'meal_ratings': ('surveys', 'survey_id'),
+    'meal_comments': ('surveys', 'survey_id'),
+}
+
+def parse_schools(value):
+    """'64:Школа 64,12:Гимназия 12' -> {'64': 'Школа 64', '12': 'Гимназия 12'}"""
+    schools = {}
+    for item in value.split(","):
+        school, _, name = item.partition(":")
+        if school.strip():
+            schools[school.strip()] = name.strip() or f"Школа {school.strip()}"
+    return schools
+
+SCHOOLS = parse_schools(os.getenv("SCHOOLS", ""))
+
+def selected_school():
+    """Школа из адреса (?school=...); None - режим одной школы.
+    
+    Неизвестная школа - ValueError: произвольный адрес не должен заводить новый раздел кэша.
+    """
+    if not SCHOOLS:
+        return None
+    school = st.query_params.get('school') or next(iter(SCHOOLS))
+    if school not in SCHOOLS:
+        raise ValueError(f"Неизвестная школа: {school}")
+    return school
+
+def school_name(school):
+    return SCHOOLS.get(school, DEFAULT_SCHOOL_NAME) if school else DEFAULT_SCHOOL_NAME
+
+def tenant_filter(table, school):
+    """Фильтр источника данных по школе (см. data_sources) или None"""
+    if school is None:
+        return None
+    if table in TENANT_PARENTS:
+        parent, key = TENANT_PARENTS[table]
+        return {'column': SCHOOL_COLUMN, 'value': school, 'parent': parent, 'key': key}
+    return {'column': SCHOOL_COLUMN, 'value': school}
+
+def estimate_bytes(value):
+    """Примерный объём памяти таблиц и массивов внутри вложенных словарей и списков"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True, index=False).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (dict, MappingProxyType)):
+        return sum(estimate_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_bytes(item) for item in value)
+    return 0
+
+@st.cache_resource
+def get_tenants():
+    """Разделы школ в порядке последнего обращения (первый - самый давний).
+    
+    build_locks - блокировки создания раздела, по одной на школу: снимок школы
+    читается под ней, а не под общей блокировкой реестра.
+    """
+    return {'tenants': OrderedDict(), 'evictions': 0, 'build_locks': {}, 'lock': threading.Lock()}
+
+def new_tenant(school):
+    """Раздел школы: состояние синхронизации и все кэши, зависящие от её данных"""
+    return {
+        'school': school,
+        'sync': new_sync_state(school),
+        'facts': OrderedDict(),  # версия -> факты, не больше FACTS_PER_TENANT
+        'anomalies': {'version': None, 'result': None, 'lock': threading.Lock()},
+        'pyramid': {'version': None, 'result': None, 'lock': threading.Lock()},
+        'comments': {'index': empty_comment_index(), 'lock': threading.Lock()},
+        'bytes': 0,
+        'lock': threading.Lock(),
+        'build_lock': threading.Lock()
+    }
+
+def get_tenant(school):
+    """Раздел школы (создаётся при первом обращении, в том числе после выгрузки)"""
+    registry = get_tenants()
+    with registry['lock']:
+        tenant = registry['tenants'].get(school)
+        if tenant is not None:
+            registry['tenants'].move_to_end(school)
+            return tenant
+        build_lock = registry['build_locks'].setdefault(school, threading.Lock())
+    
+    # Чтение снимка может быть долгим - остальные школы в это время не ждут
+    with build_lock:
+        with registry['lock']:
+            tenant = registry['tenants'].get(school)
+        if tenant is None:
+            tenant = new_tenant(school)
+        with registry['lock']:
+            registry['tenants'][school] = tenant
+            registry['tenants'].move_to_end(school)
+        return tenant
+
+def account_tenant(school):
+    """Пересчитывает объём раздела и выгружает давние школы сверх TENANT_MEMORY_MB"""
+    registry = get_tenants()
+    with registry['lock']:
+        tenant = registry['tenants'].get(school)
+    if tenant is None:
+        return
+    
+    with tenant['lock']:
+        facts_versions = list(tenant['facts'].values())
+        parts = [tenant['sync']['frames'], facts_versions, tenant['comments']['index']]
+    # Соединение DuckDB estimate_bytes не видит - его память считается отдельно
+    size = estimate_bytes(parts) + duckdb_bytes(facts_versions)
+    
+    budget = TENANT_MEMORY_MB * 2**20
+    with registry['lock']:
+        tenant['bytes'] = size
+        total = sum(item['bytes'] for item in registry['tenants'].values())
+        for other in list(registry['tenants']):
+            if total <= budget:
+                break
+            if other == school:
+                continue
+            evicted = registry['tenants'].pop(other)
+            total -= evicted['bytes']
+            registry['evictions'] += 1
+            logger.info("Школа %s выгружена из памяти (%.1f МБ)", other, evicted['bytes'] / 2**20)
+
+def duckdb_bytes(facts_versions):
+    """Память встроенных баз DuckDB у версий фактов (каждое соединение - один раз)"""
+    connections = {
+        id(facts['survey_cube']['con']): facts['survey_cube']['con']
+        for facts in facts_versions if 'con' in facts['survey_cube']
+    }
+    return sum(
+        int(con.cursor().execute('SELECT coalesce(sum(memory_usage_bytes), 0) FROM duckdb_memory()').fetchone()[0])
+        for con in connections.values()
+    )
+
+def get_sync_state(school=None):
+    """Состояние синхронизации школы"""
+    return get_tenant(school)['sync']
+
+# =============================================================================
+# СНИМОК ДАННЫХ НА ДИСКЕ
+# =============================================================================
+# Последние загруженные таблицы хранятся в Feather (Arrow IPC без сжатия), чтобы
+# после рестарта дашборд открывался сразу, даже если база недоступна.
+# Каждая версия пишется в отдельную папку, файл CURRENT указывает на последнюю целую.
+# У каждой школы свой снимок в SNAPSHOT_DIR/<школа>.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", ".snapshot")
+SNAPSHOT_FORMAT = 1  # увеличить при изменении TABLE_SCHEMAS
+SNAPSHOTS_TO_KEEP = 2
+
+# Кубы версии (prepare_facts) дописываются в её папку, как только посчитаны:
+# после рестарта первый запрос берёт их из снимка, а не пересчитывает по таблицам.
+# Кубы зависят от списка классов - при другом SCHOOL_CLASSES они не используются
+CUBES_FORMAT = 1  # увеличить при изменении build_rollups
+
+def school_snapshot_dir(school=None):
+    """Папка снимков школы (в режиме одной школы - сама SNAPSHOT_DIR)"""
+    return SNAPSHOT_DIR if school is None else os.path.join(SNAPSHOT_DIR, school)
+
+def save_snapshot(frames, watermarks, version, last_full_sync, school=None):
+    """Атомарно сохраняет версию данных на диск"""
+    base_dir = school_snapshot_dir(school)
     try:
-        surveys_response = _supabase.table("surveys").select("*").execute()
-        users_response = _supabase.table("users").select("*").execute()
-        meal_ratings_response = _supabase.table("meal_ratings").select("*").execute()
-        meal_comments_response = _supabase.table("meal_comments").select("*").execute()
+        os.makedirs(base_dir, exist_ok=True)
+        name = f"v{version:06d}"
+        target_dir = os.path.join(base_dir, name)
+        tmp_dir = f"{target_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
         
-        surveys_df = pd.DataFrame(surveys_response.data)
-        users_df = pd.DataFrame(users_response.data)
-        meal_ratings_df = pd.DataFrame(meal_ratings_response.data)
-        meal_comments_df = pd.DataFrame(meal_comments_response.data)
+        for table, df in frames.items():
+            df.reset_index(drop=True).to_feather(
+                os.path.join(tmp_dir, f"{table}.feather"), compression='uncompressed'
+            )
         
-        return {
-            'surveys': surveys_df,
-            'users': users_df,
-            'meal_ratings': meal_ratings_df,
-            'meal_comments': meal_comments_df
+        manifest = {
+            'format': SNAPSHOT_FORMAT,
+            'version': version,
+            'saved_at': time.time(),
+            'last_full_sync': last_full_sync,
+            'watermarks': watermarks,
+            'watermark_columns': {table: config['watermark'] for table, config in SYNC_TABLES.items()},
+            'tables': list(frames)
         }
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, default=str)
+        
+        shutil.rmtree(target_dir, ignore_errors=True)
+        os.replace(tmp_dir, target_dir)
+        
+        # Переключаем указатель на новую версию одной атомарной операцией
+        pointer_tmp = os.path.join(base_dir, 'CURRENT.tmp')
+        with open(pointer_tmp, 'w', encoding='utf-8') as f:
+            f.write(name)
+        os.replace(pointer_tmp, os.path.join(base_dir, 'CURRENT'))
+        
+        # Старые версии больше не нужны
+        versions = sorted(d for d in os.listdir(base_dir) if d.startswith('v') and not d.endswith('.tmp'))
+        for old_name in versions[:-SNAPSHOTS_TO_KEEP]:
+            shutil.rmtree(os.path.join(base_dir, old_name), ignore_errors=True)
     except Exception as e:
-        st.error(f"Ошибка загрузки данных: {e}")
+        logger.warning("Не удалось сохранить снимок данных: %s", e)
+
+def save_snapshot_cubes(facts, version, school=None):
+    """Дописывает кубы версии к её снимку (если снимок есть и кубов в нём ещё нет)"""
+    snapshot_dir = os.path.join(school_snapshot_dir(school), f"v{version:06d}")
+    marker = os.path.join(snapshot_dir, 'cubes.json')
+    if not os.path.isdir(snapshot_dir) or os.path.exists(marker):
+        return
+    try:
+        for name in ('survey_cube', 'rating_cube'):
+            path = os.path.join(snapshot_dir, f"{name}.feather")
+            facts[name]['frame'].to_feather(f"{path}.tmp", compression='uncompressed')
+            os.replace(f"{path}.tmp", path)
+        # cubes.json пишется последним: без него кубы считаются недописанными
+        with open(f"{marker}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({
+                'format': CUBES_FORMAT,
+                'classes': CLASS_REGISTRY,
+                'dropped_classes': {
+                    str(name): int(count) for name, count in facts['dropped_classes'].items()
+                }
+            }, f, ensure_ascii=False)
+        os.replace(f"{marker}.tmp", marker)
+    except Exception as e:
+        logger.warning("Не удалось сохранить кубы в снимок: %s", e)
+
+def load_snapshot_cubes(snapshot_dir, version):
+    """Кубы из папки снимка (None, если их нет или они посчитаны для других классов)"""
+    try:
+        with open(os.path.join(snapshot_dir, 'cubes.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get('format') != CUBES_FORMAT or meta.get('classes') != CLASS_REGISTRY:
         return None
+    return {
+        'version': version,
+        'survey_cube': pd.read_feather(os.path.join(snapshot_dir, 'survey_cube.feather')),
+        'rating_cube': pd.read_feather(os.path.join(snapshot_dir, 'rating_cube.feather')),
+        'dropped_classes': pd.Series(meta['dropped_classes'], dtype='int64')
+    }
 
-def normalize_class_name(class_name):
-    """Нормализует названия классов - оставляем только 10А и 11А"""
-    if pd.isna(class_name):
+def load_snapshot(school=None):
+    """Читает последний целый снимок школы (None, если его нет или он устарел)"""
+    base_dir = school_snapshot_dir(school)
+    try:
+        with open(os.path.join(base_dir, 'CURRENT'), encoding='utf-8') as f:
+            snapshot_dir = os.path.join(base_dir, f.read().strip())
+        with open(os.path.join(snapshot_dir, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != SNAPSHOT_FORMAT:
+            return None
+        
+        frames = {}
+        for table in SYNC_TABLES:
+            # memory_map: файл отображается в память, а не читается целиком
+            arrow_table = feather.read_table(os.path.join(snapshot_dir, f"{table}.feather"), memory_map=True)
+            # apply_schema возвращает обычный DataFrame - закрываем его снова (без копирования)
+            frames[table] = FrozenFrame(apply_schema(freeze_arrow_table(arrow_table), table))
+        
+        logger.info("Данные подняты из снимка %s", snapshot_dir)
+        return {
+            'frames': frames,
+            # Знак, снятый с другой колонки (сменилась SYNC_WATERMARKS), не годится -
+            # такая таблица при первой синхронизации загрузится целиком
+            'watermarks': {
+                table: value for table, value in manifest['watermarks'].items()
+                if manifest.get('watermark_columns', {}).get(table, 'id') == SYNC_TABLES[table]['watermark']
+            },
+            'version': manifest['version'],
+            'last_full_sync': manifest['last_full_sync'],
+            'refreshed_at': manifest['saved_at'],
+            'snapshot_cubes': load_snapshot_cubes(snapshot_dir, manifest['version'])
+        }
+    except FileNotFoundError:
         return None
-    
-    class_name = str(class_name).strip().upper()
-    
-    if class_name in ['10А', '10A', '10А']:
-        return '10А'
-    elif class_name in ['11А', '11A', '11А']:
-        return '11А'
+    except Exception as e:
+        logger.warning("Не удалось прочитать снимок данных: %s", e)
+        return None
+
+# Сколько секунд опубликованная версия считается свежей. Устаревшая версия
+# продолжает отдаваться сессиям, пока фоновый поток собирает новую
+DATA_REFRESH_INTERVAL = int(os.getenv("DATA_REFRESH_INTERVAL", "300"))
+
+def make_dataset(state):
+    """Набор таблиц текущей версии для сессий (общий, только для чтения).
+    
+    Версия включает школу: по ней различаются записи общих кэшей (графиков).
+    """
+    frames, version = read_state_frames(state)
+    return MappingProxyType({
+        'surveys': frames['surveys'],
+        'users': frames['users'],
+        'meal_ratings': frames['meal_ratings'],
+        'meal_comments': frames['meal_comments'],
+        'school': state['school'],
+        'version': (state['school'], version),
+        'rewritten_version': state['rewritten_version']
+    })
+
+def warm_dataset(dataset):
+    """Считает производные данные новой версии до того, как её увидят сессии"""
+    facts = get_facts(dataset)
+    get_day_anomalies(dataset, facts)
+    get_time_pyramid(dataset, facts)
+    # Индекс комментариев дополняем, только если его уже кто-то строил
+    if get_tenant(dataset['school'])['comments']['index']['version'] is not None:
+        get_comment_view(dataset['version'], dataset)
+
+def refresh_dataset(_source, state):
+    """Загружает изменения, готовит новую версию и атомарно подменяет опубликованную"""
+    started = time.perf_counter()
+    sync_tables(_source, state)
+    dataset = make_dataset(state)
+    
+    current = state['dataset']
+    if current is None or current['version'] != dataset['version']:
+        warm_dataset(dataset)
     else:
+        dataset = current
+    
+    with state['lock']:
+        state['dataset'] = dataset
+        state['refreshed_at'] = time.time()
+        state['refresh_seconds'] = round(time.perf_counter() - started, 3)
+        state['checked_at'] = state['refreshed_at']
+        state['refresh_error'] = None
+    log_perf_event({'stage': 'refresh', 'version': dataset['version'], 'seconds': state['refresh_seconds']})
+    account_tenant(state['school'])
+
+def refresh_in_background(_source, state):
+    """Запускает обновление данных в фоновом потоке (не больше одного на процесс).
+    
+    Возвращает поток обновления - уже идущий или только что запущенный.
+    """
+    with state['lock']:
+        thread = state['refresh_thread']
+        if thread is not None and thread.is_alive():
+            return thread
+        
+        def worker():
+            try:
+                refresh_dataset(_source, state)
+            except Exception as e:
+                logger.warning("Фоновое обновление данных не удалось: %s", e)
+                with state['lock']:
+                    state['refresh_error'] = str(e)
+                    # Повторим не сразу, а после следующего интервала
+                    state['checked_at'] = time.time()
+        
+        thread = threading.Thread(target=worker, name="data-refresh", daemon=True)
+        state['refresh_thread'] = thread
+        thread.start()
+        return thread
+
+def get_refresh_status(school=None):
+    """Возраст опубликованных данных школы и сведения о последнем обновлении"""
+    state = get_sync_state(school)
+    with state['lock']:
+        thread = state['refresh_thread']
+        return {
+            'version': state['dataset']['version'] if state['dataset'] is not None else None,
+            'age': time.time() - state['refreshed_at'] if state['refreshed_at'] else None,
+            'refresh_seconds': state['refresh_seconds'],
+            'refreshing': thread is not None and thread.is_alive(),
+            'error': state['refresh_error']
+        }
+
+def load_real_data(_source, school=None):
+    """Текущая опубликованная версия данных (общая для всех сессий, только для чтения).
+    
+    Устаревшая версия отдаётся сразу, а новая собирается в фоне и подменяет её
+    целиком (stale-while-revalidate). Ждать приходится только самому первому
+    запуску без снимка на диске - и все сессии ждут одну и ту же загрузку.
+    """
+    try:
+        state = get_sync_state(school)
+        with state['lock']:
+            dataset = state['dataset']
+            checked_at = state['checked_at']
+        
+        if dataset is None:
+            note_cache_miss('load_real_data')
+            refresh_in_background(_source, state).join()
+            with state['lock']:
+                dataset = state['dataset']
+                error = state['refresh_error']
+            if dataset is None:
+                raise RuntimeError(error or "данные не загружены")
+        elif checked_at is None or time.time() - checked_at >= DATA_REFRESH_INTERVAL:
+            # Снимок с диска или устаревшая версия: показываем её, а базу опрашиваем в фоне
+            refresh_in_background(_source, state)
+        
+        return dataset
+    except Exception as e:
+        st.error(f"Ошибка загрузки данных: {e}")
         return None
 
-def filter_and_normalize_classes(merged_df):
-    """Нормализует классы и оставляет только 10А и 11А"""
+# Латинские буквы, похожие на кириллические, которыми часто пишут литеру класса
+LATIN_TO_CYRILLIC = str.maketrans("ABEKMHOPCTXY", "АВЕКМНОРСТХУ")
+
+def normalize_class_labels(names):
+    """Единое написание названий классов: без пробелов и дефисов, заглавная кириллица"""
+    return (
+        pd.Series(names, dtype=object).astype(str)
+        .str.strip()
+        .str.upper()
+        .str.replace(r'[\s\-]+', '', regex=True)
+        .str.translate(LATIN_TO_CYRILLIC)
+    )
+
+# Реестр классов: какие классы показывает дашборд (через запятую в SCHOOL_CLASSES).
+# Новые классы добавляются переменной окружения, без правки кода. Записи реестра
+# приводятся к тому же написанию, что и данные, повторы убираются
+CLASS_REGISTRY = list(dict.fromkeys(normalize_class_labels(
+    [cls for cls in os.getenv("SCHOOL_CLASSES", "10А,11А").split(",") if cls.strip()]
+)))
+
+def normalize_class_names(classes):
+    """Векторно нормализует названия классов по реестру.
+    
+    Нормализация выполняется только для уникальных значений (категорий),
+    а строки получают результат через коды категорий.
+    Неизвестные классы и пропуски превращаются в NaN.
+    """
+    if not isinstance(classes.dtype, pd.CategoricalDtype):
+        classes = classes.astype('category')
+    
+    normalized = normalize_class_labels(classes.cat.categories)
+    
+    # Код категории реестра для каждой исходной категории (-1 - класса нет в реестре)
+    registry_codes = pd.Index(CLASS_REGISTRY).get_indexer(normalized)
+    codes = classes.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, registry_codes[codes], -1)
+    
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories=CLASS_REGISTRY),
+        index=classes.index,
+        name=classes.name
+    )
+
+def filter_and_normalize_classes(merged_df, return_dropped=False):
+    """Нормализует классы и оставляет только классы из реестра.
+    
+    С return_dropped=True дополнительно возвращает число отброшенных строк
+    по исходному названию класса.
+    """
     if merged_df.empty or 'class' not in merged_df.columns:
-        return merged_df
+        return (merged_df, pd.Series(dtype='int64')) if return_dropped else merged_df
     
-    merged_df['class_normalized'] = merged_df['class'].apply(normalize_class_name)
-    filtered_df = merged_df[merged_df['class_normalized'].notna()].copy()
-    filtered_df['class'] = filtered_df['class_normalized']
-    filtered_df = filtered_df.drop('class_normalized', axis=1)
+    normalized = normalize_class_names(merged_df['class'])
+    known = normalized.notna()
     
-    return filtered_df
+    dropped = merged_df.loc[~known, 'class'].astype(object).fillna('(нет класса)').value_counts()
+    if not dropped.empty:
+        logger.info("Нормализация классов: отброшено %d из %d строк %s",
+                    int(dropped.sum()), len(merged_df), dropped.head(10).to_dict())
+    
+    filtered_df = merged_df[known].assign(**{'class': normalized[known]})
+    
+    return (filtered_df, dropped) if return_dropped else filtered_df
+
+def prepare_facts(version, _data_dict):
+    """Собирает кубы агрегатов один раз на версию данных.
+    
+    Соединения анкет с классом ученика и оценок блюд с датой и классом анкеты
+    нужны только для подсчёта кубов и не хранятся.
+    dropped_classes - сколько анкет отброшено из-за неизвестного класса.
+    Результат общий для всех сессий - его нельзя изменять на месте.
+    """
+    note_cache_miss('prepare_facts')
+    surveys_df = _data_dict['surveys']
+    users_df = _data_dict['users']
+    
+    survey_facts = surveys_df.merge(
+        users_df[['telegram_id', 'class']],
+        on='telegram_id',
+        how='left'
+    )
+    survey_facts, dropped_classes = filter_and_normalize_classes(survey_facts, return_dropped=True)
+    
+    rating_facts = _data_dict['meal_ratings'].merge(
+        survey_facts[['id', 'telegram_id', 'date', 'class']],
+        left_on='survey_id',
+        right_on='id',
+        suffixes=('', '_survey')
+    ).drop(columns='id_survey')
+    
+    # Кубы выходят отсортированными по дате - период режется бинарным поиском
+    survey_cube, rating_cube = build_rollups(survey_facts, rating_facts)
+    
+    return {
+        'survey_cube': build_date_index(survey_cube),
+        'rating_cube': build_date_index(rating_cube),
+        'dropped_classes': dropped_classes
+    }
 
 # =============================================================================
-# НОВЫЕ ФУНКЦИИ ДЛЯ ГРАФИКОВ В ПОСТЕЛЬНЫХ ТОНАХ
+# АГРЕГАТЫ (КУБ ДАТА × КЛАСС × ОЦЕНКА)
 # =============================================================================
-def get_bad_days_stats(data):
-    """Находит дни с плохими оценками (средняя оценка < 3.0)"""
-    if data.empty:
-        return []
+# Все метрики и графики считаются по маленьким кубам сумм и количеств,
+# а не по исходным строкам: размер куба зависит от числа дней, а не анкет.
+#
+# survey_cube: date, class, overall_satisfaction, count, eats_count, rating_sum, rated_count
+# rating_cube: date, class, meal_type, rating, count
+#
+# Анкеты без общей оценки остаются в кубе корзиной overall_satisfaction = <NA>:
+# они входят в число анкет и в статистику питания, но не в средние (rating_sum
+# и rated_count считают только анкеты с оценкой). Оценки блюд без значения в
+# rating_cube не попадают - по ним строятся только распределения и средние.
+def build_rollups(survey_facts, rating_facts):
+    """Считает кубы агрегатов один раз на версию данных"""
+    survey_cube = (
+        survey_facts
+        .assign(eats_count=survey_facts['eats_at_school'].fillna(False).astype('int64'))
+        .groupby(['date', 'class', 'overall_satisfaction'], observed=True, dropna=False)
+        .agg(count=('id', 'size'), eats_count=('eats_count', 'sum'))
+        .reset_index()
+    )
+    rated = survey_cube['overall_satisfaction'].notna()
+    survey_cube['rating_sum'] = survey_cube['overall_satisfaction'].astype('Int64').fillna(0).astype('int64') * survey_cube['count']
+    survey_cube['rated_count'] = survey_cube['count'].where(rated, 0)
+    
+    rating_cube = (
+        rating_facts
+        .groupby(['date', 'class', 'meal_type', 'rating'], observed=True)
+        .size()
+        .reset_index(name='count')
+    )
     
-    daily_stats = data.groupby('date').agg({
-        'overall_satisfaction': ['mean', 'count']
-    }).round(2)
-    daily_stats.columns = ['avg_rating', 'survey_count']
-    daily_stats = daily_stats.reset_index()
+    return (
+        survey_cube.sort_values('date', kind='stable', ignore_index=True),
+        rating_cube.sort_values('date', kind='stable', ignore_index=True)
+    )
+
+def build_date_index(cube):
+    """Индекс по дате для отсортированного куба: массив дат и разбиение по классам.
+    
+    {'frame': куб, 'dates': даты, 'classes': {класс: {'frame': ..., 'dates': ...}}}
+    """
+    partitions = {
+        cls: part.reset_index(drop=True)
+        for cls, part in cube.groupby('class', observed=True, sort=False)
+    }
+    return {
+        'frame': cube,
+        'dates': cube['date'].to_numpy(),
+        'classes': {
+            cls: {'frame': part, 'dates': part['date'].to_numpy()}
+            for cls, part in partitions.items()
+        }
+    }
+
+def filter_cube(cube_index, selected_class=None, date_range=None):
+    """Срез куба по классу и периоду без полного просмотра строк.
     
-    # Дни с плохими оценками
-    bad_days = daily_stats[daily_stats['avg_rating'] < 3.0]
+    Класс выбирает готовый раздел, период - непрерывный отрезок,
+    найденный бинарным поиском по отсортированным датам.
+    """
+    if 'sql' in cube_index:
+        return query_cube(cube_index, selected_class, date_range)
     
-    return bad_days.to_dict('records')
+    part = cube_index
+    if selected_class and selected_class != "Все классы":
+        part = cube_index['classes'].get(selected_class)
+        if part is None:
+            return cube_index['frame'].iloc[0:0]
+    
+    cube = part['frame']
+    if date_range and len(date_range) == 2:
+        start_date, end_date = date_range
+        start = np.searchsorted(part['dates'], pd.Timestamp(start_date).to_datetime64(), side='left')
+        end = np.searchsorted(part['dates'], pd.Timestamp(end_date).to_datetime64(), side='right')
+        cube = cube.iloc[start:end]
+    
+    return cube
+
+def rollup(survey_cube, by):
+    """Сворачивает куб анкет до нужного разреза: количество, сумма и средняя оценки"""
+    stats = survey_cube.groupby(by, observed=True)[['count', 'rating_sum', 'rated_count', 'eats_count']].sum().reset_index()
+    stats['avg_rating'] = stats['rating_sum'] / stats['rated_count']
+    return stats
+
+def first_changed_date(previous, current, keys, value_columns):
+    """Первая дата, строки которой различаются в двух версиях куба (None - изменений нет)"""
+    compared = current.merge(previous, on=keys, how='outer', suffixes=('', '_prev'), indicator=True)
+    changed = compared['_merge'] != 'both'
+    for column in value_columns:
+        changed = changed | (compared[column] != compared[f'{column}_prev'])
+    if not changed.any():
+        return None
+    return compared.loc[changed, 'date'].min()
+
+def summarize_cube(survey_cube):
+    """Итоги по срезу: число анкет, средняя и максимальная оценки"""
+    total = int(survey_cube['count'].sum())
+    rated = int(survey_cube['rated_count'].sum())
+    if rated == 0:
+        return total, None, None
+    return total, survey_cube['rating_sum'].sum() / rated, survey_cube['overall_satisfaction'].max()
+
+# =============================================================================
+# ВСТРОЕННЫЙ SQL-ДВИЖОК (DUCKDB)
+# =============================================================================
+# QUERY_ENGINE=duckdb: таблицы версии подключаются к встроенной базе DuckDB как
+# представления (без копирования - DuckDB читает те же буферы, что лежат в
+# состоянии синхронизации), а соединения, фильтры и агрегаты для графиков
+# выполняются SQL-запросами - в pandas приходят только маленькие срезы куба.
+# Нужен пакет duckdb (pip install duckdb).
+QUERY_ENGINE = os.getenv("QUERY_ENGINE", "pandas")
+
+SURVEY_CUBE_SQL = """
+    SELECT date, class, overall_satisfaction,
+           count(*) AS count,
+           count_if(eats_at_school)::BIGINT AS eats_count,
+           coalesce(sum(overall_satisfaction), 0)::BIGINT AS rating_sum,
+           count(overall_satisfaction) AS rated_count
+    FROM survey_facts
+    {where}
+    GROUP BY date, class, overall_satisfaction
+    ORDER BY date, class, overall_satisfaction
+"""
+
+RATING_CUBE_SQL = """
+    SELECT date, class, meal_type, rating, count(*) AS count
+    FROM rating_facts
+    {where}
+    GROUP BY date, class, meal_type, rating
+    ORDER BY date, class, meal_type, rating
+"""
+
+def use_duckdb():
+    """Включён ли режим DuckDB (и установлен ли пакет)"""
+    if QUERY_ENGINE != 'duckdb':
+        return False
+    if duckdb is None:
+        logger.warning("QUERY_ENGINE=duckdb, но пакет duckdb не установлен - используется pandas")
+        return False
+    return True
+
+def prepare_facts_duckdb(version, _data_dict):
+    """То же, что prepare_facts, но факты - представления во встроенной базе DuckDB.
+    
+    Вместо индексов по дате возвращает описания кубов, срезы которых
+    filter_cube получает SQL-запросом.
+    """
+    note_cache_miss('prepare_facts')
+    con = duckdb.connect(database=':memory:')
+    # Таблицы версии неизменяемы, поэтому их можно читать на месте
+    tables = {table: _data_dict[table] for table in ('surveys', 'users', 'meal_ratings')}
+    for table, df in tables.items():
+        con.register(table, df)
+    
+    # Нормализация классов: считаем её в pandas по уникальным названиям
+    raw_classes = _data_dict['users']['class'].dropna().astype(str).drop_duplicates()
+    class_map = pd.DataFrame({
+        'raw_class': raw_classes.to_numpy(),
+        'class': normalize_class_names(raw_classes).astype(object).to_numpy()
+    }).dropna()
+    con.register('class_map_df', class_map)
+    con.execute('CREATE TABLE class_map AS SELECT * FROM class_map_df')
+    con.unregister('class_map_df')
+    
+    con.execute("""
+        CREATE VIEW survey_facts AS
+        SELECT s.id, s.telegram_id, s.date, s.overall_satisfaction, s.eats_at_school, m.class
+        FROM surveys s
+        JOIN users u ON u.telegram_id = s.telegram_id
+        JOIN class_map m ON m.raw_class = CAST(u.class AS VARCHAR)
+    """)
+    con.execute("""
+        CREATE VIEW rating_facts AS
+        SELECT r.id, r.survey_id, r.meal_type, r.rating, f.date, f.class
+        FROM meal_ratings r
+        JOIN survey_facts f ON f.id = r.survey_id
+    """)
+    
+    dropped_classes = con.execute("""
+        SELECT coalesce(CAST(u.class AS VARCHAR), '(нет класса)') AS raw_class, count(*) AS count
+        FROM surveys s
+        LEFT JOIN users u ON u.telegram_id = s.telegram_id
+        LEFT JOIN class_map m ON m.raw_class = CAST(u.class AS VARCHAR)
+        WHERE m.class IS NULL
+        GROUP BY 1
+        ORDER BY 2 DESC
+    """).df().set_index('raw_class')['count']
+    
+    survey_cube = {'con': con, 'tables': tables, 'sql': SURVEY_CUBE_SQL}
+    rating_cube = {'con': con, 'tables': tables, 'sql': RATING_CUBE_SQL}
+    survey_cube['frame'] = query_cube(survey_cube)
+    rating_cube['frame'] = query_cube(rating_cube)
+    
+    return {
+        'survey_cube': survey_cube,
+        'rating_cube': rating_cube,
+        'dropped_classes': dropped_classes
+    }
+
+# Сколько последних версий фактов держит раздел школы: текущую и готовящуюся
+FACTS_PER_TENANT = 2
+
+def snapshot_facts(state, version):
+    """Факты версии из кубов снимка (None, если снимок был другой версии или без кубов)"""
+    with state['lock']:
+        cubes = state['snapshot_cubes']
+        state['snapshot_cubes'] = None
+    if cubes is None or cubes['version'] != version[1]:
+        return None
+    return {
+        'survey_cube': build_date_index(cubes['survey_cube']),
+        'rating_cube': build_date_index(cubes['rating_cube']),
+        'dropped_classes': cubes['dropped_classes']
+    }
+
+def get_facts(data_dict):
+    """Факты и кубы версии данных выбранным движком (pandas или DuckDB).
+    
+    Строятся один раз на версию и хранятся в разделе школы.
+    """
+    tenant = get_tenant(data_dict.get('school'))
+    version = data_dict['version']
+    with tenant['lock']:
+        facts = tenant['facts'].get(version)
+    if facts is not None:
+        return facts
+    
+    # Сессии, читающие уже готовую версию, этой блокировки не ждут
+    with tenant['build_lock']:
+        with tenant['lock']:
+            facts = tenant['facts'].get(version)
+        if facts is None:
+            if use_duckdb():
+                facts = prepare_facts_duckdb(version, data_dict)
+            else:
+                facts = snapshot_facts(tenant['sync'], version)
+                if facts is None:
+                    facts = prepare_facts(version, data_dict)
+                    save_snapshot_cubes(facts, version[1], tenant['school'])
+            with tenant['lock']:
+                tenant['facts'][version] = facts
+                while len(tenant['facts']) > FACTS_PER_TENANT:
+                    tenant['facts'].popitem(last=False)
+    account_tenant(tenant['school'])
+    return facts
+
+def query_cube(cube_index, selected_class=None, date_range=None):
+    """Срез куба SQL-запросом: фильтры уходят в WHERE, агрегация - в GROUP BY"""
+    conditions = []
+    params = []
+    if selected_class and selected_class != "Все классы":
+        conditions.append('class = ?')
+        params.append(selected_class)
+    if date_range and len(date_range) == 2:
+        conditions.append('date BETWEEN ? AND ?')
+        params.extend(pd.Timestamp(value).to_pydatetime() for value in date_range)
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    # Отдельный курсор на запрос: соединение общее для всех сессий.
+    # Подключённые таблицы курсор не наследует - подключаем их заново (без копирования)
+    cursor = cube_index['con'].cursor()
+    for table, df in cube_index['tables'].items():
+        cursor.register(table, df)
+    cube = cursor.execute(cube_index['sql'].format(where=where), params).df()
+    cube['class'] = pd.Categorical(cube['class'], categories=CLASS_REGISTRY)
+    return cube
+
+# =============================================================================
+# АНОМАЛЬНЫЕ ДНИ
+# =============================================================================
+# Вместо фиксированного порога 3.0 каждый день сравнивается со своей историей.
+# Для каждого класса (и итога по всем классам), а также для каждого типа блюда
+# берутся средние оценки за ANOMALY_WINDOW предыдущих дней с анкетами:
+# скользящее среднее, разброс дневных средних и обычное число анкет в день.
+# z-оценка дня = (оценка дня - скользящее среднее) / разброс.
+# Плохой день - z-оценка ниже -ANOMALY_Z или анкет меньше LOW_PARTICIPATION_SHARE от обычного.
+ANOMALY_WINDOW = int(os.getenv("ANOMALY_WINDOW", "10"))
+ANOMALY_MIN_DAYS = int(os.getenv("ANOMALY_MIN_DAYS", "5"))
+ANOMALY_Z = float(os.getenv("ANOMALY_Z", "2.0"))
+LOW_PARTICIPATION_SHARE = float(os.getenv("LOW_PARTICIPATION_SHARE", "0.5"))
+ANOMALY_MIN_SURVEYS = int(os.getenv("ANOMALY_MIN_SURVEYS", "3"))  # по 1-2 анкетам о дне не судим
+MIN_RATING_SPREAD = 0.1  # чтобы почти постоянная история не давала бесконечных z-оценок
+
+def daily_rating_stats(cube, group_columns):
+    """Число оценок и их сумма по дням: по классам и итог по всем классам"""
+    rating_column = 'overall_satisfaction' if 'overall_satisfaction' in cube.columns else 'rating'
+    # Анкеты без оценки не влияют ни на среднюю, ни на обычное число оценок в день
+    cube = cube[cube[rating_column].notna()]
+    cube = cube.assign(rating_sum=cube[rating_column].astype('int64') * cube['count'])
+    extra_columns = [column for column in group_columns if column != 'class']
+    
+    by_class = cube.groupby(['class', *extra_columns, 'date'], observed=True)[['count', 'rating_sum']].sum().reset_index()
+    overall = cube.groupby([*extra_columns, 'date'], observed=True)[['count', 'rating_sum']].sum().reset_index()
+    daily = pd.concat([
+        by_class.assign(**{'class': by_class['class'].astype(str)}),
+        overall.assign(**{'class': "Все классы"})
+    ], ignore_index=True)
+    for column in extra_columns:
+        daily[column] = daily[column].astype(str)
+    return daily.sort_values([*group_columns, 'date'], ignore_index=True)
+
+def rolling_day_stats(daily, group_columns, position_offset=0):
+    """Скользящие статистики каждого дня по предыдущим ANOMALY_WINDOW дням его группы.
+    
+    daily отсортирован по группе и дате. position_offset - сколько дней группы
+    отрезано перед daily (при пересчёте только хвоста истории).
+    """
+    groups = [daily[column] for column in group_columns]
+    avg_rating = daily['rating_sum'] / daily['count']
+    values = pd.DataFrame({'avg_rating': avg_rating, 'avg_sq': avg_rating ** 2, 'count': daily['count']})
+    
+    # Сумма по окну = разность накопленных сумм (без текущего дня)
+    window = {}
+    for column in values.columns:
+        cumulative = values[column].groupby(groups, sort=False).cumsum().groupby(groups, sort=False)
+        window[column] = cumulative.shift(1).fillna(0) - cumulative.shift(ANOMALY_WINDOW + 1).fillna(0)
+    
+    position = daily.groupby(groups, sort=False).cumcount() + position_offset
+    days = np.minimum(position, ANOMALY_WINDOW).where(position >= ANOMALY_MIN_DAYS)
+    baseline = window['avg_rating'] / days
+    spread = np.sqrt((window['avg_sq'] / days - baseline ** 2).clip(lower=0)).clip(lower=MIN_RATING_SPREAD)
+    z_score = (avg_rating - baseline) / spread
+    participation = daily['count'] / (window['count'] / days)
+    
+    stats = daily[[*group_columns, 'date', 'count']].assign(
+        avg_rating=avg_rating,
+        baseline=baseline,
+        band_low=baseline - ANOMALY_Z * spread,
+        band_high=baseline + ANOMALY_Z * spread,
+        z_score=z_score,
+        participation=participation
+    )
+    stats['low_rating'] = (stats['z_score'] <= -ANOMALY_Z) & (stats['count'] >= ANOMALY_MIN_SURVEYS)
+    stats['low_participation'] = stats['participation'] < LOW_PARTICIPATION_SHARE
+    stats['severity'] = (-stats['z_score']).clip(lower=0).fillna(0)
+    return stats
+
+def update_rolling_stats(previous, daily, group_columns):
+    """Статистики новой версии: пересчитываются только дни начиная с первого изменившегося.
+    
+    previous - {'daily', 'stats'} прошлой версии или None.
+    Новые дни в конце истории пересчитываются вместе с ANOMALY_WINDOW днями перед ними.
+    """
+    if previous is None:
+        return {'daily': daily, 'stats': rolling_day_stats(daily, group_columns)}
+    
+    keys = [*group_columns, 'date']
+    start = first_changed_date(previous['daily'], daily, keys, ['count', 'rating_sum'])
+    if start is None:
+        return {'daily': daily, 'stats': previous['stats']}
+    
+    # Для каждой группы берём дни с start и ещё ANOMALY_WINDOW дней истории перед ними
+    groups = [daily[column] for column in group_columns]
+    position = daily.groupby(groups, sort=False).cumcount()
+    first_changed = position.where(daily['date'] >= start).groupby(groups, sort=False).transform('min')
+    tail_mask = first_changed.notna() & (position >= first_changed - ANOMALY_WINDOW)
+    tail = daily[tail_mask].reset_index(drop=True)
+    tail_offset = position[tail_mask].groupby([column[tail_mask] for column in groups], sort=False).transform('min')
+    
+    recomputed = rolling_day_stats(tail, group_columns, tail_offset.to_numpy())
+    kept = previous['stats'][previous['stats']['date'] < start]
+    stats = pd.concat([kept, recomputed[recomputed['date'] >= start]], ignore_index=True)
+    return {'daily': daily, 'stats': stats.sort_values(keys, ignore_index=True)}
+
+def update_day_anomalies(previous, survey_cube, rating_cube):
+    """Скользящие статистики по дням для классов и для типов блюд"""
+    previous = previous or {}
+    return {
+        'class_days': update_rolling_stats(
+            previous.get('class_days'), daily_rating_stats(survey_cube, ['class']), ['class']
+        ),
+        'meal_days': update_rolling_stats(
+            previous.get('meal_days'), daily_rating_stats(rating_cube, ['class', 'meal_type']), ['class', 'meal_type']
+        )
+    }
+
+def get_day_anomalies(data_dict, facts):
+    """Статистики дней для версии данных: считаются один раз, затем дополняются.
+    
+    Последние посчитанные статистики хранятся в разделе школы.
+    """
+    version = data_dict['version']
+    state = get_tenant(data_dict.get('school'))['anomalies']
+    with state['lock']:
+        if state['version'] != version:
+            state['result'] = update_day_anomalies(
+                state['result'], facts['survey_cube']['frame'], facts['rating_cube']['frame']
+            )
+            state['version'] = version
+        return {name: part['stats'] for name, part in state['result'].items()}
+
+def select_day_stats(day_stats, selected_class=None, date_range=None):
+    """Статистики дней класса (или всех классов) за период"""
+    cls = selected_class if selected_class and selected_class != "Все классы" else "Все классы"
+    selected = day_stats[day_stats['class'] == cls]
+    if date_range and len(date_range) == 2:
+        start_date, end_date = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1])
+        selected = selected[selected['date'].between(start_date, end_date)]
+    return selected
+
+# =============================================================================
+# ШАГ ГРАФИКОВ ПО ВРЕМЕНИ (ДЕНЬ / НЕДЕЛЯ / МЕСЯЦ / ЧЕТВЕРТЬ)
+# =============================================================================
+# Для каждого шага заранее хранится свой куб тех же сумм и количеств, что и у
+# дневного куба анкет; дата в нём - начало недели, месяца или четверти.
+# Грубый шаг читает несколько десятков готовых строк вместо всех дней.
+# С новой версией данных пересчитываются только корзины начиная с той, в
+# которую попал первый изменившийся день, - более ранние берутся из прошлой версии.
+GRANULARITIES = {
+    'day': "по дням",
+    'week': "по неделям",
+    'month': "по месяцам",
+    'term': "по четвертям"
+}
+
+# Начала учебных четвертей (ММ-ДД); дни до первой границы года относятся
+# к последней четверти прошлого года
+SCHOOL_TERM_STARTS = sorted(
+    tuple(int(part) for part in item.strip().split('-'))
+    for item in os.getenv("SCHOOL_TERM_STARTS", "09-01,11-01,01-01,04-01").split(',')
+    if item.strip()
+)
+
+def bucket_starts(dates, granularity):
+    """Начало корзины шага для каждой даты (массив numpy той же точности)"""
+    values = np.asarray(dates)
+    days = values.astype('datetime64[D]')
+    if granularity == 'week':
+        # 1970-01-01 - четверг, поэтому понедельник недели - сдвиг на (день + 3) % 7
+        starts = days - (days.astype('int64') + 3) % 7
+    elif granularity == 'month':
+        starts = days.astype('datetime64[M]').astype('datetime64[D]')
+    elif granularity == 'term':
+        months = days.astype('datetime64[M]')
+        years = days.astype('datetime64[Y]').astype('int64') + 1970
+        keys = (months.astype('int64') % 12 + 1) * 100 + (days - months.astype('datetime64[D]')).astype('int64') + 1
+        bounds = np.array([month * 100 + day for month, day in SCHOOL_TERM_STARTS])
+        positions = np.searchsorted(bounds, keys, side='right') - 1
+        years = years - (positions < 0)
+        bounds = bounds[positions % len(bounds)]
+        starts = (
+            ((years - 1970) * 12 + bounds // 100 - 1).astype('datetime64[M]').astype('datetime64[D]')
+            + (bounds % 100 - 1).astype('timedelta64[D]')
+        )
+    else:
+        starts = days
+    return starts.astype(values.dtype)
+
+def rollup_granularity(survey_cube, granularity):
+    """Куб анкет шага: суммы и количества по корзинам, отсортирован по дате"""
+    return (
+        survey_cube
+        .assign(date=bucket_starts(survey_cube['date'], granularity))
+        .groupby(['date', 'class', 'overall_satisfaction'], observed=True, dropna=False)[['count', 'eats_count', 'rating_sum', 'rated_count']]
+        .sum()
+        .reset_index()
+    )
+
+def update_time_pyramid(previous, survey_cube):
+    """Кубы всех шагов для новой версии дневного куба.
+    
+    previous - результат для прошлой версии (или None - считаем всё).
+    Возвращает {'daily': дневной куб, 'levels': {шаг: индекс куба (build_date_index)}}.
+    """
+    keys = ['date', 'class', 'overall_satisfaction']
+    start = None
+    if previous is not None:
+        start = first_changed_date(previous['daily'], survey_cube, keys, ['count', 'eats_count', 'rating_sum', 'rated_count'])
+        if start is None:
+            return {'daily': survey_cube, 'levels': previous['levels']}
+    
+    levels = {}
+    for granularity in GRANULARITIES:
+        if granularity == 'day':
+            continue
+        if start is None:
+            cube = rollup_granularity(survey_cube, granularity)
+        else:
+            bucket = bucket_starts(np.array([start.to_datetime64()]), granularity)[0]
+            kept = previous['levels'][granularity]['frame']
+            kept = kept.iloc[:np.searchsorted(kept['date'].to_numpy(), bucket, side='left')]
+            changed = survey_cube.iloc[np.searchsorted(survey_cube['date'].to_numpy(), bucket, side='left'):]
+            cube = pd.concat([kept, rollup_granularity(changed, granularity)], ignore_index=True)
+        levels[granularity] = build_date_index(cube)
+    return {'daily': survey_cube, 'levels': levels}
+
+def get_time_pyramid(data_dict, facts):
+    """Индексы кубов всех шагов для версии данных (дневной - из фактов).
+    
+    Последняя посчитанная пирамида хранится в разделе школы.
+    """
+    version = data_dict['version']
+    state = get_tenant(data_dict.get('school'))['pyramid']
+    with state['lock']:
+        if state['version'] != version:
+            state['result'] = update_time_pyramid(state['result'], facts['survey_cube']['frame'])
+            state['version'] = version
+        return {'day': facts['survey_cube'], **state['result']['levels']}
+
+def granularity_date_range(date_range, granularity):
+    """Период для куба шага: начало сдвигается к началу его корзины"""
+    if not date_range or len(date_range) != 2 or granularity == 'day':
+        return date_range
+    start = bucket_starts(np.array([pd.Timestamp(date_range[0]).to_datetime64()]), granularity)[0]
+    return (pd.Timestamp(start).date(), date_range[1])
+
+# =============================================================================
+# ПРОРЕЖИВАНИЕ ДЛИННЫХ РЯДОВ
+# =============================================================================
+# За несколько учебных лет дневные графики набирают тысячи точек на линию:
+# растёт и размер фигуры, и время отрисовки SVG на телефоне. Если в линии
+# больше CHART_POINT_BUDGET точек, она прореживается алгоритмом
+# Largest-Triangle-Three-Buckets (сохраняет форму ряда, пики и провалы),
+# а график рисуется через WebGL (Scattergl). При сужении периода в фильтре
+# точек становится меньше бюджета, и график снова строится по всем дням.
+CHART_POINT_BUDGET = int(os.getenv("CHART_POINT_BUDGET", "500"))
 
-def create_daily_avg_ratings_chart(data, selected_class=None):
-    """График средних оценок по дням (усреднение по 3 блюдам)"""
+def lttb_indices(x, y, threshold):
+    """Номера точек, оставляемых Largest-Triangle-Three-Buckets.
+    
+    Первая и последняя точки сохраняются, остальные делятся на threshold - 2
+    корзин, и из каждой берётся точка, образующая наибольший треугольник
+    с уже выбранной точкой и средней точкой следующей корзины.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    edges = (np.arange(threshold - 1) * (n - 2) / (threshold - 2)).astype('int64') + 1
+    edges[-1] = n - 1
+    
+    selected = np.empty(threshold, dtype='int64')
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        
+        area = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(area.argmax())
+        selected[bucket + 1] = previous
+    return selected
+
+def downsample_series(df, x_column, y_column, budget=None):
+    """Ряд, прореженный до бюджета точек (или тот же ряд, если точек меньше)"""
+    budget = budget or CHART_POINT_BUDGET
+    if len(df) <= budget:
+        return df
+    x = df[x_column].to_numpy()
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype('datetime64[s]').astype('int64')
+    return df.iloc[lttb_indices(x, df[y_column].to_numpy(), budget)]
+
+def downsample_groups(df, group_column, x_column, y_column):
+    """Прореживает каждую линию графика отдельно; возвращает (ряды, прорежено ли)"""
+    sizes = df.groupby(group_column, observed=True).size()
+    if sizes.empty or sizes.max() <= CHART_POINT_BUDGET:
+        return df, False
+    parts = [
+        downsample_series(part, x_column, y_column)
+        for _, part in df.groupby(group_column, observed=True, sort=False)
+    ]
+    return pd.concat(parts, ignore_index=True), True
+
+# =============================================================================
+# НОВЫЕ ФУНКЦИИ ДЛЯ ГРАФИКОВ В ПОСТЕЛЬНЫХ ТОНАХ
+# =============================================================================
+def get_bad_days_stats(anomalies, selected_class=None, date_range=None):
+    """Аномально плохие дни класса за период, от самого тяжёлого.
+    
+    Для каждого дня указывается и тип блюда, оценки которого просели сильнее всего.
+    """
+    days = select_day_stats(anomalies['class_days'], selected_class, date_range)
+    bad_days = days[days['low_rating'] | days['low_participation']]
+    if bad_days.empty:
+        return []
+    bad_days = bad_days.sort_values(['severity', 'participation'], ascending=[False, True])
+    
+    meals = select_day_stats(anomalies['meal_days'], selected_class, date_range)
+    meals = meals[meals['date'].isin(bad_days['date']) & meals['z_score'].notna()]
+    worst_meals = meals.sort_values('z_score').drop_duplicates('date').set_index('date')
+    
+    return [
+        {
+            'date': row.date,
+            'avg_rating': round(float(row.avg_rating), 2),
+            'baseline': None if pd.isna(row.baseline) else round(float(row.baseline), 2),
+            'z_score': None if pd.isna(row.z_score) else round(float(row.z_score), 1),
+            'survey_count': int(row.count),
+            'participation': None if pd.isna(row.participation) else round(float(row.participation), 2),
+            'low_rating': bool(row.low_rating),
+            'low_participation': bool(row.low_participation),
+            'worst_meal': worst_meals['meal_type'].get(row.date),
+            'worst_meal_z': None if row.date not in worst_meals.index else round(float(worst_meals.at[row.date, 'z_score']), 1)
+        }
+        for row in bad_days.itertuples(index=False)
+    ]
+
+def create_daily_avg_ratings_chart(data, selected_class=None, day_stats=None, granularity='day'):
+    """График средних оценок по дням (усреднение по 3 блюдам).
+    
+    day_stats - скользящие статистики дней (select_day_stats): по ним рисуется
+    коридор обычных значений вокруг скользящего среднего.
+    granularity - шаг графика (GRANULARITIES); data - куб этого шага.
+    """
     if data.empty:
         return None
     
     # Фильтрация по классу
     if selected_class and selected_class != "Все классы":
         filtered_data = data[data['class'] == selected_class]
-        title = f'Средние оценки по дням - {selected_class}'
+        title = f'Средние оценки {GRANULARITIES[granularity]} - {selected_class}'
     else:
         filtered_data = data
-        title = 'Средние оценки по дням'
+        title = f'Средние оценки {GRANULARITIES[granularity]}'
+    
+    # Сворачиваем куб по дате и считаем среднюю оценку
+    daily_stats = rollup(filtered_data, 'date')
+    daily_stats['overall_satisfaction'] = daily_stats['avg_rating'].round(2)
     
-    # Группируем по дате и считаем среднюю оценку
-    daily_stats = filtered_data.groupby('date').agg({
-        'overall_satisfaction': 'mean'
-    }).round(2).reset_index()
+    # Длинный ряд прореживается и рисуется через WebGL
+    plotted = downsample_series(daily_stats, 'date', 'overall_satisfaction')
+    webgl = len(plotted) < len(daily_stats)
     
     fig = px.line(
-        daily_stats,
+        plotted,
         x='date',
         y='overall_satisfaction',
         title=title,
         labels={'date': 'Дата', 'overall_satisfaction': 'Средняя оценка'},
-        color_discrete_sequence=['#84592B']
+        color_discrete_sequence=['#84592B'],
+        render_mode='webgl' if webgl else 'auto'
     )
     
     # УВЕЛИЧИВАЕМ ШРИФТЫ В ГРАФИКАХ
@@ -300,11 +1908,21 @@ def create_daily_avg_ratings_chart(data, selected_class=None):
         marker=dict(size=10, color='#743014')
     )
     
-    # Добавляем горизонтальную линию для порога "плохого дня"
-    fig.add_hline(y=3.0, line_dash="dash", line_color="#743014", 
-                 annotation_text="Порог низкой оценки", 
-                 annotation_position="bottom right",
-                 annotation_font_size=16)
+    # Коридор обычных значений: скользящее среднее ± ANOMALY_Z разбросов.
+    # Дни ниже коридора считаются аномально плохими
+    if day_stats is not None and day_stats['baseline'].notna().any():
+        band = day_stats[['date', 'band_low', 'band_high']].dropna()
+        band = downsample_series(band, 'date', 'band_low')
+        band_trace = go.Scattergl if webgl else go.Scatter
+        fig.add_trace(band_trace(
+            x=band['date'], y=band['band_high'],
+            mode='lines', line=dict(width=0), hoverinfo='skip', showlegend=False
+        ))
+        fig.add_trace(band_trace(
+            x=band['date'], y=band['band_low'],
+            mode='lines', line=dict(width=0), fill='tonexty',
+            fillcolor='rgba(157, 145, 103, 0.25)', name='Обычный диапазон', hoverinfo='skip'
+        ))
     
     return fig
 
@@ -330,7 +1948,8 @@ def create_rating_distribution(data, selected_class=None):
     }
     
     # Создаем гистограмму с помощью go.Bar для индивидуальных цветов
-    rating_counts = filtered_data['overall_satisfaction'].value_counts().sort_index()
+    rating_counts = filtered_data.groupby('overall_satisfaction')['count'].sum()
+    rating_counts = rating_counts[rating_counts > 0]
     
     # Создаем списки для данных
     ratings = []
@@ -376,8 +1995,8 @@ def create_class_comparison(data):
     if data.empty:
         return None
         
-    class_stats = data.groupby('class')['overall_satisfaction'].agg(['mean', 'count']).reset_index()
-    class_stats = class_stats[class_stats['count'] > 0]
+    class_stats = rollup(data, 'class').rename(columns={'avg_rating': 'mean'})
+    class_stats = class_stats[class_stats['rated_count'] > 0]
     
     # Постельная цветовая шкала
     fig = px.bar(
@@ -414,9 +2033,9 @@ def get_eating_statistics(data):
         return 0, 0, 0
     
     # Считаем по всем анкетам, а не по уникальным пользователям
-    eats_at_school_count = data['eats_at_school'].sum()
-    not_eat_at_school_count = len(data) - eats_at_school_count
-    total_entries = len(data)
+    eats_at_school_count = int(data['eats_count'].sum())
+    total_entries = int(data['count'].sum())
+    not_eat_at_school_count = total_entries - eats_at_school_count
     
     return eats_at_school_count, not_eat_at_school_count, total_entries
 
@@ -425,43 +2044,21 @@ def get_daily_eating_statistics(data):
     if data.empty:
         return pd.DataFrame()
     
-    # Группируем по дате и считаем анкеты
-    daily_stats = data.groupby('date').agg({
-        'eats_at_school': ['count', 'sum']  # Всего анкет и питающихся
-    }).reset_index()
-    
+    # Сворачиваем куб по дате: всего анкет и питающихся
+    daily_stats = rollup(data, 'date')[['date', 'count', 'eats_count']]
     daily_stats.columns = ['date', 'total_surveys', 'eats_at_school_count']
     daily_stats['not_eat_count'] = daily_stats['total_surveys'] - daily_stats['eats_at_school_count']
     daily_stats['eat_percentage'] = (daily_stats['eats_at_school_count'] / daily_stats['total_surveys'] * 100).round(1)
     
     return daily_stats
 
-def create_meal_ratings_pie_charts(meal_ratings_df, surveys_df, users_df, selected_class=None, date_range=None):
-    """Три круговые диаграммы оценок по типам блюд"""
-    
-    # Объединяем данные
-    merged_ratings = meal_ratings_df.merge(
-        surveys_df[['id', 'telegram_id', 'date']], 
-        left_on='survey_id', 
-        right_on='id'
-    ).merge(
-        users_df[['telegram_id', 'class']], 
-        on='telegram_id'
-    )
-    
-    # Нормализуем и фильтруем классы
-    merged_ratings = filter_and_normalize_classes(merged_ratings)
+def create_meal_ratings_pie_charts(rating_cube, selected_class=None, date_range=None):
+    """Три круговые диаграммы оценок по типам блюд.
     
+    rating_cube - индекс куба оценок блюд (см. build_date_index)
+    """
     # Применяем фильтры
-    if selected_class and selected_class != "Все классы":
-        merged_ratings = merged_ratings[merged_ratings['class'] == selected_class]
-    
-    if date_range and len(date_range) == 2:
-        start_date, end_date = date_range
-        merged_ratings = merged_ratings[
-            (merged_ratings['date'] >= pd.to_datetime(start_date)) & 
-            (merged_ratings['date'] <= pd.to_datetime(end_date))
-        ]
+    merged_ratings = filter_cube(rating_cube, selected_class, date_range)
     
     if merged_ratings.empty:
         return None
@@ -492,7 +2089,8 @@ def create_meal_ratings_pie_charts(meal_ratings_df, surveys_df, users_df, select
                 font=dict(size=18)
             )
         else:
-            rating_counts = meal_data['rating'].value_counts().sort_index(ascending=False)  # Сортируем от 5 к 1
+            rating_counts = meal_data.groupby('rating')['count'].sum()
+            rating_counts = rating_counts[rating_counts > 0].sort_index(ascending=False)  # Сортируем от 5 к 1
             
             # Создаем данные для диаграммы с фиксированными цветами
             labels = []
@@ -534,32 +2132,16 @@ def create_meal_ratings_pie_charts(meal_ratings_df, surveys_df, users_df, select
     
     return figs
 
-def create_daily_surveys_chart(surveys_df, users_df, selected_class=None, date_range=None):
-    """График количества анкет по дням"""
-    # Объединяем данные
-    merged_data = surveys_df.merge(
-        users_df[['telegram_id', 'class']], 
-        on='telegram_id',
-        how='left'
-    )
+def create_daily_surveys_chart(survey_cube, selected_class=None, date_range=None, granularity='day'):
+    """График количества анкет по дням.
     
-    # Нормализуем и фильтруем классы
-    merged_data = filter_and_normalize_classes(merged_data)
-    
-    if merged_data.empty:
+    survey_cube - индекс куба анкет шага granularity (см. build_date_index)
+    """
+    if survey_cube['frame'].empty:
         return None
     
     # Применяем фильтры
-    filtered_data = merged_data.copy()
-    if selected_class and selected_class != "Все классы":
-        filtered_data = filtered_data[filtered_data['class'] == selected_class]
-    
-    if date_range and len(date_range) == 2:
-        start_date, end_date = date_range
-        filtered_data = filtered_data[
-            (filtered_data['date'] >= pd.to_datetime(start_date)) & 
-            (filtered_data['date'] <= pd.to_datetime(end_date))
-        ]
+    filtered_data = filter_cube(survey_cube, selected_class, date_range)
     
     if filtered_data.empty:
         return None
@@ -569,17 +2151,20 @@ def create_daily_surveys_chart(surveys_df, users_df, selected_class=None, date_r
     
     # Группируем по дате и классу
     if selected_class == "Все классы":
-        daily_stats = filtered_data.groupby(['date', 'class']).size().reset_index(name='count')
+        daily_stats = rollup(filtered_data, ['date', 'class'])
+        # Длинные ряды прореживаются и рисуются через WebGL
+        daily_stats, webgl = downsample_groups(daily_stats, 'class', 'date', 'count')
         
         fig = px.line(
             daily_stats,
             x='date',
             y='count',
             color='class',
-            title='Активность голосований по дням',
+            title=f'Активность голосований {GRANULARITIES[granularity]}',
             color_discrete_map=class_colors,
             labels={'date': 'Дата', 'count': 'Количество анкет', 'class': 'Класс'},
-            markers=True
+            markers=True,
+            render_mode='webgl' if webgl else 'auto'
         )
         
         # Увеличиваем контрастность линий
@@ -589,19 +2174,25 @@ def create_daily_surveys_chart(surveys_df, users_df, selected_class=None, date_r
         )
         
     else:
-        daily_stats = filtered_data.groupby('date').size().reset_index(name='count')
+        daily_stats = rollup(filtered_data, 'date')
+        plotted = downsample_series(daily_stats, 'date', 'count')
+        webgl = len(plotted) < len(daily_stats)
         
         # Используем контрастный цвет для одиночного класса
         single_class_color = '#84592B' if selected_class == '10А' else '#743014'
         
         fig = px.line(
-            daily_stats,
+            plotted,
             x='date',
             y='count',
-            title=f'Активность голосований - {selected_class}',
+            title=(
+                f'Активность голосований - {selected_class}' if granularity == 'day'
+                else f'Активность голосований {GRANULARITIES[granularity]} - {selected_class}'
+            ),
             color_discrete_sequence=[single_class_color],
             labels={'date': 'Дата', 'count': 'Количество анкет'},
-            markers=True
+            markers=True,
+            render_mode='webgl' if webgl else 'auto'
         )
         fig.update_traces(
             line=dict(width=4),
@@ -635,11 +2226,474 @@ def create_daily_surveys_chart(surveys_df, users_df, selected_class=None, date_r
     return fig
 
 # =============================================================================
-# ОСНОВНОЕ ПРИЛОЖЕНИЕ
+# АНАЛИТИКА КОММЕНТАРИЕВ
 # =============================================================================
-def main():
+# Комментарии разбиваются на основы слов (грубое отсечение окончаний) и
+# складываются в инвертированный индекс: основа -> номера комментариев.
+# Индекс общий для всех сессий и дополняется только новыми комментариями;
+# заново он строится, лишь если старые комментарии изменились (полная синхронизация).
+COMMENT_TOKEN_PATTERN = re.compile(r"[a-zа-я0-9]+")
+
+COMMENT_STOPWORDS = {
+    'и', 'в', 'во', 'не', 'что', 'он', 'на', 'я', 'с', 'со', 'как', 'а', 'то', 'все', 'всё',
+    'она', 'так', 'его', 'но', 'да', 'ты', 'к', 'у', 'же', 'вы', 'за', 'бы', 'по', 'только',
+    'ее', 'её', 'мне', 'было', 'был', 'была', 'были', 'вот', 'от', 'меня', 'еще', 'ещё', 'нет',
+    'о', 'из', 'ему', 'ли', 'если', 'уже', 'или', 'ни', 'быть', 'до', 'вас', 'нибудь', 'очень',
+    'там', 'потом', 'себя', 'ей', 'они', 'тут', 'где', 'есть', 'для', 'мы', 'их', 'чем',
+    'это', 'этот', 'эта', 'эти', 'при', 'без', 'сегодня', 'слишком', 'спасибо', 'всем', 'весь'
+}
+
+# Окончания русских прилагательных, причастий, глаголов и существительных (длинные - первыми)
+COMMENT_ENDINGS = sorted([
+    'ившись', 'ывшись', 'ившая', 'ывшая', 'ющими', 'ющего', 'ющему', 'ающий',
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие',
+    'ый', 'ий', 'ой', 'ую', 'юю', 'ом', 'ем', 'ах', 'ях', 'ов', 'ев', 'ей', 'ия', 'ью',
+    'ена', 'ено', 'ены', 'ен', 'на', 'но', 'ны', 'ть', 'ла', 'ло', 'ли', 'ет', 'ют', 'ат', 'ят',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь'
+], key=len, reverse=True)
+
+# Слова-жалобы (через запятую в COMPLAINT_KEYWORDS) сравниваются по основам
+COMPLAINT_KEYWORDS = [
+    word.strip() for word in os.getenv(
+        "COMPLAINT_KEYWORDS",
+        "холодный,остывший,пересолено,недосолено,соли,невкусно,переварены,пережарено,"
+        "подгорело,сырое,чёрствый,мало,сладкий,кислый,горький,жёсткий,волос,грязный"
+    ).split(",") if word.strip()
+]
+
+@lru_cache(maxsize=100_000)
+def stem_word(word):
+    """Основа слова: отсекает самое длинное подходящее окончание (основа - от 3 букв)"""
+    for ending in COMMENT_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+def tokenize_comment(text):
+    """Пары (основа, слово) комментария без стоп-слов и повторов основ"""
+    tokens = {}
+    for word in COMMENT_TOKEN_PATTERN.findall(str(text).lower().replace('ё', 'е')):
+        if len(word) < 3 or word in COMMENT_STOPWORDS:
+            continue
+        tokens.setdefault(stem_word(word), word)
+    return tokens
+
+COMPLAINT_STEMS = {stem for word in COMPLAINT_KEYWORDS for stem in tokenize_comment(word)}
+
+def empty_comment_index():
+    """Пустой индекс комментариев"""
+    return {
+        'version': None,
+        'rewritten_version': None,
+        'watermark': None,
+        'rows': 0,
+        'docs': pd.DataFrame(columns=['id', 'survey_id', 'meal_type', 'comment', 'date', 'class']),
+        'vocab': {},
+        'terms': [],
+        'forms': [],
+        'postings': {},
+        'doc_ids': np.empty(0, dtype='int64'),
+        'term_ids': np.empty(0, dtype='int64')
+    }
+
+def comment_docs(comments, surveys, users):
+    """Комментарии с датой и нормализованным классом анкеты"""
+    docs = comments.merge(
+        surveys[['id', 'telegram_id', 'date']], left_on='survey_id', right_on='id',
+        how='left', suffixes=('', '_survey')
+    ).merge(users[['telegram_id', 'class']], on='telegram_id', how='left')
+    docs = docs.assign(**{'class': normalize_class_names(docs['class'])})
+    return docs[['id', 'survey_id', 'meal_type', 'comment', 'date', 'class']]
+
+def extend_comment_index(index, new_docs, version, rewritten_version, watermark, rows):
+    """Новый индекс = старый + new_docs. Старый не меняется - читатели могут им пользоваться"""
+    vocab = dict(index['vocab'])
+    terms = list(index['terms'])
+    forms = list(index['forms'])
+    offset = len(index['docs'])
+    
+    doc_ids = []
+    term_ids = []
+    new_forms = {}
+    for position, text in enumerate(new_docs['comment'].tolist()):
+        for stem, word in tokenize_comment(text).items():
+            term_id = vocab.get(stem)
+            if term_id is None:
+                term_id = vocab[stem] = len(terms)
+                terms.append(stem)
+                forms.append({})
+            doc_ids.append(offset + position)
+            term_ids.append(term_id)
+            batch_forms = new_forms.setdefault(term_id, {})
+            batch_forms[word] = batch_forms.get(word, 0) + 1
+    
+    # Частоты словоформ - чтобы показывать основу самым частым написанием
+    for term_id, batch_forms in new_forms.items():
+        merged = dict(forms[term_id])
+        for word, count in batch_forms.items():
+            merged[word] = merged.get(word, 0) + count
+        forms[term_id] = merged
+    
+    doc_ids = np.asarray(doc_ids, dtype='int64')
+    term_ids = np.asarray(term_ids, dtype='int64')
+    
+    # Постинги дополняются только для основ, встретившихся в новых комментариях
+    postings = dict(index['postings'])
+    if len(term_ids):
+        order = np.argsort(term_ids, kind='stable')
+        sorted_terms = term_ids[order]
+        bounds = np.flatnonzero(np.diff(sorted_terms)) + 1
+        for chunk in np.split(order, bounds):
+            term_id = int(term_ids[chunk[0]])
+            new_postings = doc_ids[chunk]
+            old_postings = postings.get(term_id)
+            postings[term_id] = new_postings if old_postings is None else np.concatenate([old_postings, new_postings])
+    
+    docs = new_docs if index['docs'].empty else pd.concat([index['docs'], new_docs], ignore_index=True)
+    return {
+        'version': version,
+        'rewritten_version': rewritten_version,
+        'watermark': watermark,
+        'rows': rows,
+        'docs': docs.reset_index(drop=True),
+        'vocab': vocab,
+        'terms': terms,
+        'forms': forms,
+        'postings': postings,
+        'doc_ids': np.concatenate([index['doc_ids'], doc_ids]),
+        'term_ids': np.concatenate([index['term_ids'], term_ids])
+    }
+
+def get_comment_view(version, data_dict):
+    """Индекс комментариев для версии данных (дополняется новыми комментариями).
+    
+    Индекс хранится один - для самой новой версии. Сессия, оставшаяся на более
+    старой версии (фрагмент после фоновой подмены данных), получает его же:
+    назад индекс не перестраивается.
+    """
+    holder = get_tenant(data_dict.get('school'))['comments']
+    with holder['lock']:
+        index = holder['index']
+        if index['version'] is not None and index['version'][1] >= version[1]:
+            return index
+        
+        comments = data_dict['meal_comments']
+        watermark = index['watermark']
+        new_comments = comments if watermark is None else comments[comments['id'] > watermark]
+        rewritten_version = data_dict.get('rewritten_version')
+        if rewritten_version != index['rewritten_version'] or len(comments) - len(new_comments) != index['rows']:
+            # Старые комментарии, даты или классы анкет изменились - строим индекс заново
+            index = empty_comment_index()
+            new_comments = comments
+        
+        with timed('comment_index', rows=len(new_comments)):
+            new_docs = comment_docs(new_comments, data_dict['surveys'], data_dict['users'])
+            holder['index'] = extend_comment_index(
+                index, new_docs, version, rewritten_version, get_watermark(comments, 'id'), len(comments)
+            )
+        return holder['index']
+
+def comment_display_term(index, term_id):
+    """Самое частое написание основы"""
+    forms = index['forms'][term_id]
+    return max(forms, key=forms.get) if forms else index['terms'][term_id]
+
+def filter_comment_docs(index, selected_class=None, date_range=None, meal_type=None):
+    """Маска комментариев известных классов по фильтрам дашборда"""
+    docs = index['docs']
+    mask = docs['class'].notna().to_numpy()
+    if selected_class and selected_class != "Все классы":
+        mask = mask & (docs['class'] == selected_class).to_numpy()
+    if date_range and len(date_range) == 2:
+        start_date, end_date = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1])
+        mask = mask & docs['date'].between(start_date, end_date).to_numpy()
+    if meal_type:
+        mask = mask & (docs['meal_type'] == meal_type).to_numpy()
+    return mask
+
+def top_comment_terms(index, mask, limit=15):
+    """Самые частые слова в отфильтрованных комментариях (по числу комментариев)"""
+    if not len(index['term_ids']) or not mask.any():
+        return pd.DataFrame(columns=['term', 'count', 'complaint'])
+    
+    selected = mask[index['doc_ids']]
+    counts = np.bincount(index['term_ids'][selected], minlength=len(index['terms']))
+    top_ids = np.argsort(-counts, kind='stable')[:limit]
+    top_ids = top_ids[counts[top_ids] > 0]
+    return pd.DataFrame({
+        'term': [comment_display_term(index, term_id) for term_id in top_ids],
+        'count': counts[top_ids],
+        'complaint': [index['terms'][term_id] in COMPLAINT_STEMS for term_id in top_ids]
+    })
+
+def search_comments(index, query, mask):
+    """Номера комментариев, содержащих все слова запроса (с учётом маски)"""
+    stems = list(tokenize_comment(query))
+    if not stems:
+        return np.flatnonzero(mask)
+    
+    found = None
+    for stem in stems:
+        term_id = index['vocab'].get(stem)
+        postings = index['postings'].get(term_id) if term_id is not None else None
+        if postings is None:
+            return np.empty(0, dtype='int64')
+        found = postings if found is None else np.intersect1d(found, postings, assume_unique=True)
+    return found[mask[found]]
+
+def complaint_stats(index, mask):
+    """Комментарии с жалобами: по дням и по классу × типу блюда"""
+    complaint_ids = [index['vocab'][stem] for stem in COMPLAINT_STEMS if stem in index['vocab']]
+    docs = index['docs']
+    if not complaint_ids or not mask.any():
+        return pd.DataFrame(columns=['date', 'term', 'count']), pd.DataFrame()
+    
+    names = {term_id: comment_display_term(index, term_id) for term_id in complaint_ids}
+    selected = mask[index['doc_ids']] & np.isin(index['term_ids'], complaint_ids)
+    pairs = pd.DataFrame({
+        'doc': index['doc_ids'][selected],
+        'term': pd.Series(index['term_ids'][selected]).map(names).to_numpy()
+    })
+    pairs['date'] = docs['date'].to_numpy()[pairs['doc']]
+    by_day = pairs.groupby(['date', 'term']).size().reset_index(name='count')
+    
+    complaint_docs = docs.iloc[np.unique(pairs['doc'])]
+    by_group = pd.crosstab(
+        complaint_docs['class'].astype(str).rename('Класс'),
+        complaint_docs['meal_type'].astype(str).rename(None)
+    )
+    return by_day, by_group
+
+def comment_rows(index, positions, limit=200):
+    """Исходные комментарии для показа: сначала новые"""
+    rows = index['docs'].iloc[positions].sort_values('date', ascending=False).head(limit)
+    return rows.assign(date=rows['date'].dt.strftime('%d.%m.%Y'))[['date', 'class', 'meal_type', 'comment']].rename(
+        columns={'date': 'Дата', 'class': 'Класс', 'meal_type': 'Блюдо', 'comment': 'Комментарий'}
+    )
+
+def create_comment_terms_chart(top_terms):
+    """Частые слова в комментариях; жалобы выделены цветом"""
+    if top_terms.empty:
+        return None
+    
+    top_terms = top_terms.assign(
+        kind=np.where(top_terms['complaint'], 'Жалоба', 'Слово')
+    ).iloc[::-1]
+    fig = px.bar(
+        top_terms,
+        x='count',
+        y='term',
+        orientation='h',
+        color='kind',
+        title='Частые слова в комментариях',
+        color_discrete_map={'Жалоба': '#743014', 'Слово': '#9D9167'},
+        labels={'count': 'Комментариев', 'term': '', 'kind': ''}
+    )
+    
+    fig.update_layout(
+        font=dict(size=18),
+        title_font_size=24,
+        xaxis=dict(title_font_size=20, tickfont_size=18),
+        yaxis=dict(tickfont_size=18, categoryorder='total ascending'),
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+    )
+    return fig
+
+def create_complaints_chart(complaints_by_day):
+    """Жалобы по дням с разбивкой по словам"""
+    if complaints_by_day.empty:
+        return None
+    
+    fig = px.bar(
+        complaints_by_day,
+        x='date',
+        y='count',
+        color='term',
+        title='Жалобы в комментариях по дням',
+        color_discrete_sequence=['#743014', '#84592B', '#9D9167', '#E8D1A7', '#5D5D5D'],
+        labels={'date': 'Дата', 'count': 'Комментариев', 'term': 'Жалоба'}
+    )
+    
+    fig.update_layout(
+        font=dict(size=18),
+        title_font_size=24,
+        xaxis=dict(tickformat='%d.%m.%Y', title_font_size=20, tickfont_size=18),
+        yaxis=dict(title_font_size=20, tickfont_size=18),
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+        barmode='stack'
+    )
+    return fig
+
+# =============================================================================
+# КЭШ ГРАФИКОВ
+# =============================================================================
+# Готовые графики хранятся в виде JSON и переиспользуются всеми сессиями:
+# ключ - название графика, версия данных, класс и период.
+# Ключей класс x период бесконечно много, поэтому кэш ограничен по памяти:
+# объём каждой записи учитывается в байтах, и при превышении бюджета
+# выгружаются давно не нужные (lru) или редко нужные (lfu) записи.
+#
+# lfu со старением (LFU-DA): приоритет записи - число обращений плюс «возраст»
+# кэша на момент последнего обращения, а возраст растёт до приоритета каждой
+# выгруженной записи. Иначе графики прошлой версии данных с сотней обращений
+# навсегда вытесняли бы новые, которым ещё не успели набрать популярность.
+FIGURE_CACHE_SIZE = int(os.getenv("FIGURE_CACHE_SIZE", "256"))
+FIGURE_CACHE_MB = float(os.getenv("FIGURE_CACHE_MB", "64"))
+FIGURE_CACHE_POLICY = os.getenv("FIGURE_CACHE_POLICY", "lru")
+
+def new_bounded_cache(budget_bytes, max_entries=None, policy='lru'):
+    """Кэш с учётом размера записей: не больше budget_bytes и max_entries записей"""
+    if policy not in ('lru', 'lfu'):
+        raise ValueError(f"Неизвестная политика вытеснения: {policy}")
+    return {
+        'entries': OrderedDict(),  # ключ -> {'value', 'bytes', 'uses', 'priority'}, от давних к свежим
+        'budget': budget_bytes,
+        'max_entries': max_entries,
+        'policy': policy,
+        'age': 0,  # для lfu: приоритет последней выгруженной записи
+        'bytes': 0,
+        'hits': 0,
+        'misses': 0,
+        'evictions': 0,
+        'rejected': 0,
+        'lock': threading.Lock()
+    }
+
+def cache_lookup(cache, key):
+    """(найдено, значение); найденная запись становится самой свежей"""
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry is None:
+            cache['misses'] += 1
+            return False, None
+        cache['entries'].move_to_end(key)
+        entry['uses'] += 1
+        entry['priority'] = cache['age'] + entry['uses']
+        cache['hits'] += 1
+        return True, entry['value']
+
+def evict_entry(cache):
+    """Выгружает одну запись по политике кэша (вызывается под блокировкой)"""
+    entries = cache['entries']
+    if cache['policy'] == 'lfu':
+        # Среди записей с равным приоритетом выгружается самая давняя: min берёт первую
+        key = min(entries, key=lambda name: entries[name]['priority'])
+        cache['age'] = entries[key]['priority']
+    else:
+        key = next(iter(entries))
+    cache['bytes'] -= entries.pop(key)['bytes']
+    cache['evictions'] += 1
+
+def cache_store(cache, key, value, size):
+    """Кладёт значение размером size байт и выгружает лишнее.
+    
+    Запись больше всего бюджета не кэшируется.
+    """
+    with cache['lock']:
+        if key in cache['entries']:
+            cache['bytes'] -= cache['entries'].pop(key)['bytes']
+        if size > cache['budget']:
+            cache['rejected'] += 1
+            return
+        max_entries = cache['max_entries']
+        while cache['entries'] and (
+            cache['bytes'] + size > cache['budget']
+            or (max_entries and len(cache['entries']) >= max_entries)
+        ):
+            evict_entry(cache)
+        cache['entries'][key] = {'value': value, 'bytes': size, 'uses': 0, 'priority': cache['age']}
+        cache['bytes'] += size
+
+def cache_stats(cache):
+    """Доля попаданий, число выгрузок и занятая память кэша"""
+    with cache['lock']:
+        lookups = cache['hits'] + cache['misses']
+        return {
+            'entries': len(cache['entries']),
+            'bytes': cache['bytes'],
+            'budget': cache['budget'],
+            'policy': cache['policy'],
+            'hits': cache['hits'],
+            'misses': cache['misses'],
+            'hit_rate': cache['hits'] / lookups if lookups else None,
+            'evictions': cache['evictions'],
+            'rejected': cache['rejected']
+        }
+
+@st.cache_resource
+def get_figure_cache():
+    """Общий кэш сериализованных графиков, ограниченный по памяти"""
+    return new_bounded_cache(int(FIGURE_CACHE_MB * 2**20), FIGURE_CACHE_SIZE, FIGURE_CACHE_POLICY)
+
+def figure_cache_key(chart_name, version, selected_class, date_range):
+    """Ключ кэша графика: даты приводятся к строкам, чтобы ключ был хешируемым"""
+    dates = tuple(str(value) for value in date_range) if date_range else None
+    return (chart_name, version, selected_class, dates)
+
+def cached_figure(chart_name, version, selected_class, date_range, build):
+    """Возвращает график из кэша или строит его функцией build.
+    
+    build может вернуть фигуру, список фигур или None - кэшируется любой результат.
+    """
+    cache = get_figure_cache()
+    key = figure_cache_key(chart_name, version, selected_class, date_range)
+    
+    with timed(f'figure:{chart_name}') as perf:
+        hit, serialized = cache_lookup(cache, key)
+        
+        perf['cache'] = 'hit' if hit else 'miss'
+        if hit:
+            return deserialize_figure(serialized)
+        
+        result = build()
+        serialized = serialize_figure(result)
+        size = serialized_bytes(serialized)
+        perf['bytes'] = size
+        cache_store(cache, key, serialized, size)
+        
+        return result
+
+def show_chart(fig, chart_name):
+    """st.plotly_chart с замером времени отрисовки"""
+    with timed(f'plotly_chart:{chart_name}'):
+        st.plotly_chart(fig, width='stretch')
+
+def serialize_figure(result):
+    """Фигура (или список фигур) -> JSON"""
+    if result is None:
+        return None
+    if isinstance(result, list):
+        return [fig.to_json() for fig in result]
+    return result.to_json()
+
+def serialized_bytes(serialized):
+    """Объём JSON графика (или списка графиков) в памяти"""
+    if serialized is None:
+        return 0
+    if isinstance(serialized, list):
+        return sum(sys.getsizeof(fig_json) for fig_json in serialized)
+    return sys.getsizeof(serialized)
+
+def deserialize_figure(serialized):
+    """JSON -> фигура (или список фигур)"""
+    if serialized is None:
+        return None
+    if isinstance(serialized, list):
+        return [pio.from_json(fig_json, skip_invalid=True) for fig_json in serialized]
+    return pio.from_json(serialized, skip_invalid=True)
+
+# =============================================================================
+# РАЗДЕЛЫ СТРАНИЦЫ
+# =============================================================================
+# Каждый раздел - отдельная функция, параметры которой и есть его входные данные.
+# Разделы с графиками - фрагменты: их собственные взаимодействия перезапускают
+# только их. Разделы ниже первого экрана считаются, только когда их раскрыли.
+def render_header(name=DEFAULT_SCHOOL_NAME):
+    """Заголовок и информационный блок (не зависят от данных)"""
     # ЗАГОЛОВОК С ОПИСАНИЕМ
-    st.markdown('<h1 class="main-header">Школа 64</h1>', unsafe_allow_html=True)
+    st.markdown(f'<h1 class="main-header">{name}</h1>', unsafe_allow_html=True)
     st.markdown('<div class="sub-header">Анализ качества питания в школьной столовой</div>', unsafe_allow_html=True)
     
     # ИНФОРМАЦИОННЫЙ БЛОК
@@ -665,43 +2719,20 @@ def main():
                 </a>
             </div>
             """, unsafe_allow_html=True)
+
+def render_sidebar(survey_index):
+    """Фильтры боковой панели; возвращает (класс, период)"""
+    survey_cube = survey_index['frame']
     
-    # Инициализация Supabase
-    supabase = init_supabase()
-    if not supabase:
-        st.error("Не удалось подключиться к базе данных. Проверьте файл .env")
-        return
-    
-    # Загрузка данных
-    with st.spinner('Загрузка данных...'):
-        data_dict = load_real_data(supabase)
-    
-    if not data_dict:
-        return
-    
-    # Обработка данных
-    surveys_df = data_dict['surveys']
-    users_df = data_dict['users']
-    
-    merged_df = surveys_df.merge(users_df, on='telegram_id', how='left')
-    merged_df = filter_and_normalize_classes(merged_df)
-    
-    if not merged_df.empty:
-        merged_df['date'] = pd.to_datetime(merged_df['date'])
-        surveys_df['date'] = pd.to_datetime(surveys_df['date'])
-    
-    # =========================================================================
-    # БОКОВАЯ ПАНЕЛЬ - ФИЛЬТРЫ
-    # =========================================================================
     with st.sidebar:
         st.markdown("### Панель управления")
         st.markdown("---")
         
         # Выбор класса
         available_classes = ["Все классы"]
-        if not merged_df.empty and 'class' in merged_df.columns:
-            class_counts = merged_df['class'].value_counts()
-            for cls, count in class_counts.items():
+        if not survey_cube.empty:
+            class_counts = rollup(survey_cube, 'class').sort_values('count', ascending=False)
+            for cls, count in zip(class_counts['class'], class_counts['count']):
                 available_classes.append(f"{cls} ({count})")
         
         selected_class = st.selectbox("**Выберите класс:**", available_classes)
@@ -711,8 +2742,8 @@ def main():
         
         # Выбор даты
         available_dates = []
-        if not merged_df.empty and 'date' in merged_df.columns:
-            available_dates = sorted(merged_df['date'].dt.date.unique())
+        if not survey_cube.empty:
+            available_dates = sorted(survey_cube['date'].dt.date.unique())
         
         if available_dates:
             min_date = min(available_dates)
@@ -730,48 +2761,80 @@ def main():
         else:
             date_range = None
         
-        # Применяем фильтры
-        filtered_df = merged_df.copy()
-        if selected_class and selected_class != "Все классы":
-            filtered_df = filtered_df[filtered_df['class'] == selected_class]
-        
-        if date_range and len(date_range) == 2:
-            start_date, end_date = date_range
-            filtered_df = filtered_df[
-                (filtered_df['date'] >= pd.to_datetime(start_date)) & 
-                (filtered_df['date'] <= pd.to_datetime(end_date))
-            ]
-        
-        # Статистика
+    return selected_class, date_range
+
+def render_granularity_selector():
+    """Шаг графиков по времени: день, неделя, месяц или учебная четверть"""
+    with st.sidebar:
+        return st.radio(
+            "**Шаг графиков:**",
+            list(GRANULARITIES),
+            format_func=lambda granularity: GRANULARITIES[granularity].capitalize(),
+            horizontal=True,
+            key='granularity'
+        )
+
+def render_sidebar_stats(total_surveys, avg_rating):
+    """Краткая статистика под фильтрами"""
+    with st.sidebar:
         st.markdown("---")
         st.markdown("### Статистика")
-        st.metric("Всего анкет", len(filtered_df))
-        if not filtered_df.empty and 'overall_satisfaction' in filtered_df.columns:
-            avg_rating = filtered_df['overall_satisfaction'].mean()
+        st.metric("Всего анкет", total_surveys)
+        if avg_rating is not None:
             st.metric("Средняя оценка", f"{avg_rating:.1f}")
+
+def format_age(seconds):
+    """Возраст данных словами: 'только что', '5 мин назад', '2 ч назад'"""
+    if seconds < 60:
+        return "только что"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин назад"
+    return f"{int(seconds // 3600)} ч назад"
+
+def render_data_status(school=None):
+    """Возраст показанных данных и длительность последнего обновления"""
+    status = get_refresh_status(school)
+    with st.sidebar:
+        if status['age'] is not None:
+            text = f"Данные обновлены {format_age(status['age'])}"
+            if status['refresh_seconds'] is not None:
+                text += f" · обновление заняло {status['refresh_seconds']:.1f} с"
+            st.caption(text)
+        if status['refreshing']:
+            st.caption("Идёт обновление в фоне, пока показана прежняя версия")
+        if status['error']:
+            st.caption(f"Последнее обновление не удалось: {status['error']}")
+
+def render_bad_days(anomalies, selected_class, date_range):
+    """Аномально плохие дни: оценки ниже обычного коридора или мало анкет"""
+    bad_days = get_bad_days_stats(anomalies, selected_class, date_range)
     
-    # =========================================================================
-    # НОВЫЙ РАЗДЕЛ: ДНИ С ПЛОХИМИ ОЦЕНКАМИ
-    # =========================================================================
-    if not filtered_df.empty:
-        bad_days = get_bad_days_stats(filtered_df)
+    if bad_days:
+        st.markdown('<div class="section-header">Дни с низкими оценками</div>', unsafe_allow_html=True)
         
-        if bad_days:
-            st.markdown('<div class="section-header">Дни с низкими оценками</div>', unsafe_allow_html=True)
-            
-            st.warning("Обнаружены дни с низкими средними оценками питания:")
+        st.warning("Обнаружены дни, заметно хуже обычного для выбранного класса:")
+        
+        cols = st.columns(3)
+        for idx, day in enumerate(bad_days[:3]):  # Показываем максимум 3 худших дня
+            # Все значения пришли из базы (название блюда пишет кто угодно) -
+            # экранируем их перед вставкой в HTML
+            details = [f"Оценка: {html.escape(str(day['avg_rating']))}"]
+            if day['baseline'] is not None:
+                details.append(f"Обычно: {html.escape(str(day['baseline']))} (z = {html.escape(str(day['z_score']))})")
+            details.append(f"Анкет: {html.escape(str(day['survey_count']))}" + (" - мало" if day['low_participation'] else ""))
+            if day['worst_meal'] and day['worst_meal_z'] is not None and day['worst_meal_z'] < 0:
+                details.append(f"Просело: {html.escape(str(day['worst_meal']))}")
             
-            cols = st.columns(3)
-            for idx, day in enumerate(bad_days[:3]):  # Показываем максимум 3 худших дня
-                with cols[idx % 3]:
-                    st.markdown(f"""
-                    <div class="bad-day-badge">
-                        <strong>{day['date'].strftime('%d.%m.%Y')}</strong><br>
-                        Оценка: {day['avg_rating']}<br>
-                        Анкет: {day['survey_count']}
-                    </div>
-                    """, unsafe_allow_html=True)
-    
+            with cols[idx % 3]:
+                st.markdown(f"""
+                <div class="bad-day-badge">
+                    <strong>{html.escape(day['date'].strftime('%d.%m.%Y'))}</strong><br>
+                    {'<br>'.join(details)}
+                </div>
+                """, unsafe_allow_html=True)
+
+def render_summary(filtered_cube, total_surveys, avg_rating, max_rating):
+    """Основные метрики и статистика питания"""
     # =========================================================================
     # ОСНОВНЫЕ МЕТРИКИ С ДОПОЛНИТЕЛЬНОЙ ИНФОРМАЦИЕЙ
     # =========================================================================
@@ -780,29 +2843,26 @@ def main():
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        total_surveys = len(filtered_df)
         st.metric("Всего оценок", total_surveys)
         st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #84592B;"></div><span>Общее количество заполненных анкет</span></div></div>', unsafe_allow_html=True)
     
     with col2:
-        if not filtered_df.empty and 'overall_satisfaction' in filtered_df.columns:
-            avg_rating = filtered_df['overall_satisfaction'].mean()
+        if avg_rating is not None:
             st.metric("Средняя оценка", f"{avg_rating:.1f}")
             st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #743014;"></div><span>Средняя оценка за весь период</span></div></div>', unsafe_allow_html=True)
         else:
             st.metric("Средняя оценка", "0.0")
     
     with col3:
-        if not filtered_df.empty and 'overall_satisfaction' in filtered_df.columns:
-            max_rating = filtered_df['overall_satisfaction'].max()
+        if max_rating is not None:
             st.metric("Максимальная оценка", int(max_rating))
             st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #9D9167;"></div><span>Наивысшая полученная оценка</span></div></div>', unsafe_allow_html=True)
         else:
             st.metric("Максимальная оценка", "0")
     
     with col4:
-        if not filtered_df.empty and 'class' in filtered_df.columns:
-            unique_classes = filtered_df['class'].nunique()
+        if not filtered_cube.empty:
+            unique_classes = filtered_cube['class'].nunique()
             st.metric("Активных классов", unique_classes)
             st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #442D1C;"></div><span>Количество классов, участвующих в оценке</span></div></div>', unsafe_allow_html=True)
         else:
@@ -812,7 +2872,7 @@ def main():
     st.markdown('<div class="section-header">Статистика питания</div>', unsafe_allow_html=True)
     
     # Получаем статистику по пользователям
-    eats_count, not_eat_count, total_with_data = get_eating_statistics(filtered_df)
+    eats_count, not_eat_count, total_with_data = get_eating_statistics(filtered_cube)
     
     col1, col2, col3 = st.columns(3)
     
@@ -833,99 +2893,331 @@ def main():
             st.metric("Не питаются в школе", "Нет данных")
     
     with col3:
-        total_surveys = len(filtered_df)
         st.metric("Всего анкет", f"{total_surveys} шт.")
-        st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #9D9167;"></div><span>Общее количество заполненных анкет за период</span></div></div>', unsafe_allow_html=True)    
+        st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #9D9167;"></div><span>Общее количество заполненных анкет за период</span></div></div>', unsafe_allow_html=True)
+
+@st.fragment
+def render_rating_charts(data_version, filtered_cube, anomalies, selected_class, date_range,
+                         granularity='day', level_index=None):
+    """Динамика средних оценок, распределение оценок и сравнение классов.
+    
+    level_index - индекс куба шага granularity (для дневного шага не нужен)
+    """
+    # НОВЫЙ ГРАФИК: СРЕДНИЕ ОЦЕНКИ ПО ДНЯМ (НЕДЕЛЯМ, МЕСЯЦАМ, ЧЕТВЕРТЯМ)
+    st.markdown(f'<div class="section-header">Динамика средних оценок {GRANULARITIES[granularity]}</div>', unsafe_allow_html=True)
+    if granularity == 'day':
+        chart_cube = filtered_cube
+    else:
+        chart_cube = filter_cube(level_index, selected_class, granularity_date_range(date_range, granularity))
+    # Коридор обычных значений считается по дням - на грубом шаге его нет
+    fig_daily_avg = cached_figure(
+        f'daily_avg_ratings:{granularity}', data_version, selected_class, date_range,
+        lambda: create_daily_avg_ratings_chart(
+            chart_cube, selected_class,
+            select_day_stats(anomalies['class_days'], selected_class, date_range) if granularity == 'day' else None,
+            granularity
+        )
+    )
+    if fig_daily_avg:
+        show_chart(fig_daily_avg, 'daily_avg_ratings')
+        if granularity == 'day':
+            explanation = (
+                f"На графике показана средняя оценка питания за каждый день. Закрашенный коридор - обычный диапазон оценок "
+                f"по предыдущим {ANOMALY_WINDOW} дням. Дни ниже коридора требуют особого внимания."
+            )
+        else:
+            explanation = (
+                f"На графике показана средняя оценка питания {GRANULARITIES[granularity]}. "
+                f"Неполные неделя, месяц или четверть на краях периода учитываются целиком."
+            )
+        st.markdown(f"""
+        <div class="graph-legend">
+            <strong>Пояснение к графику:</strong><br>
+            {explanation}
+        </div>
+        """, unsafe_allow_html=True)
     
-    # =========================================================================
-    # ГРАФИКИ
-    # =========================================================================
-    if not filtered_df.empty:
-        # НОВЫЙ ГРАФИК: СРЕДНИЕ ОЦЕНКИ ПО ДНЯМ
-        st.markdown('<div class="section-header">Динамика средних оценок по дням</div>', unsafe_allow_html=True)
-        fig_daily_avg = create_daily_avg_ratings_chart(filtered_df, selected_class)
-        if fig_daily_avg:
-            st.plotly_chart(fig_daily_avg, width='stretch')
-            st.markdown("""
-            <div class="graph-legend">
-                <strong>Пояснение к графику:</strong><br>
-                На графике показана средняя оценка питания за каждый день. Пунктирная линия показывает порог низкой оценки (3.0). 
-                Дни ниже этого порога требуют особого внимания.
-            </div>
-            """, unsafe_allow_html=True)
-        
-        # Первая строка графиков
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            fig1 = create_rating_distribution(filtered_df, selected_class)
-            if fig1:
-                st.plotly_chart(fig1, width='stretch')
-                st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #84592B;"></div><span>Распределение оценок по 5-балльной шкале</span></div></div>', unsafe_allow_html=True)
+    # Первая строка графиков
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        fig1 = cached_figure(
+            'rating_distribution', data_version, selected_class, date_range,
+            lambda: create_rating_distribution(filtered_cube, selected_class)
+        )
+        if fig1:
+            show_chart(fig1, 'rating_distribution')
+            st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #84592B;"></div><span>Распределение оценок по 5-балльной шкале</span></div></div>', unsafe_allow_html=True)
+    
+    with col2:
+        fig2 = cached_figure(
+            'class_comparison', data_version, selected_class, date_range,
+            lambda: create_class_comparison(filtered_cube)
+        )
+        if fig2:
+            show_chart(fig2, 'class_comparison')
+            st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #9D9167;"></div><span>Сравнение средней оценки между классами</span></div></div>', unsafe_allow_html=True)
+
+@st.fragment
+def render_meal_ratings_section(data_version, rating_cube, selected_class, date_range):
+    """Круговые диаграммы по типам блюд (считаются только в раскрытом блоке)"""
+    st.markdown('<div class="section-header">Оценки по типам блюд</div>', unsafe_allow_html=True)
+    
+    section = st.expander("Показать диаграммы по типам блюд", key="meal_ratings_open", on_change="rerun")
+    with section:
+        if not section.open:
+            return
         
-        with col2:
-            fig2 = create_class_comparison(filtered_df)
-            if fig2:
-                st.plotly_chart(fig2, width='stretch')
-                st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #9D9167;"></div><span>Сравнение средней оценки между классами</span></div></div>', unsafe_allow_html=True)
-        
-        # Вторая строка графиков
-        st.markdown('<div class="section-header">Оценки по типам блюд</div>', unsafe_allow_html=True)
-        
-        pie_charts = create_meal_ratings_pie_charts(
-            data_dict['meal_ratings'], 
-            data_dict['surveys'], 
-            data_dict['users'],
-            selected_class,
-            date_range
+        pie_charts = cached_figure(
+            'meal_ratings_pie', data_version, selected_class, date_range,
+            lambda: create_meal_ratings_pie_charts(rating_cube, selected_class, date_range)
         )
         
         if pie_charts:
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.plotly_chart(pie_charts[0], width='stretch')
+                show_chart(pie_charts[0], 'meal_ratings_pie')
                 st.markdown('<div class="graph-legend" style="text-align: center;">Распределение оценок для первых блюд</div>', unsafe_allow_html=True)
             with col2:
-                st.plotly_chart(pie_charts[1], width='stretch')
+                show_chart(pie_charts[1], 'meal_ratings_pie')
                 st.markdown('<div class="graph-legend" style="text-align: center;">Распределение оценок для вторых блюд</div>', unsafe_allow_html=True)
             with col3:
-                st.plotly_chart(pie_charts[2], width='stretch')
+                show_chart(pie_charts[2], 'meal_ratings_pie')
                 st.markdown('<div class="graph-legend" style="text-align: center;">Распределение оценок для напитков</div>', unsafe_allow_html=True)
+
+@st.fragment
+def render_activity_section(data_version, survey_index, selected_class, date_range, granularity='day'):
+    """График активности голосований (считается только в раскрытом блоке).
+    
+    survey_index - индекс куба анкет шага granularity
+    """
+    st.markdown('<div class="section-header">Активность голосований</div>', unsafe_allow_html=True)
+    
+    section = st.expander("Показать активность по дням", key="activity_open", on_change="rerun")
+    with section:
+        if not section.open:
+            return
         
-        # Третий график
-        st.markdown('<div class="section-header">Активность голосований</div>', unsafe_allow_html=True)
-        
-        fig_daily = create_daily_surveys_chart(
-            data_dict['surveys'], 
-            data_dict['users'],
-            selected_class,
-            date_range
+        fig_daily = cached_figure(
+            f'daily_surveys:{granularity}', data_version, selected_class, date_range,
+            lambda: create_daily_surveys_chart(
+                survey_index, selected_class, granularity_date_range(date_range, granularity), granularity
+            )
         )
         if fig_daily:
-            st.plotly_chart(fig_daily, width='stretch')
-            st.markdown("""
+            show_chart(fig_daily, 'daily_surveys')
+            st.markdown(f"""
             <div class="graph-legend">
                 <strong>Пояснение к графику:</strong><br>
-                График показывает количество заполненных анкет по дням. Это помогает оценить активность учащихся в оценке питания.
+                График показывает количество заполненных анкет {GRANULARITIES[granularity]}. Это помогает оценить активность учащихся в оценке питания.
             </div>
             """, unsafe_allow_html=True)
-    
-    else:
-        st.warning("Нет данных для отображения с выбранными фильтрами")
-    
-    # =========================================================================
-    # ФУТЕР
-    # =========================================================================
+
+@st.fragment
+def render_comments_section(data_version, data_dict, selected_class, date_range):
+    """Частые слова, жалобы и поиск по комментариям (считаются только в раскрытом блоке)"""
+    st.markdown('<div class="section-header">Комментарии учеников</div>', unsafe_allow_html=True)
+    
+    section = st.expander("Показать анализ комментариев", key="comments_open", on_change="rerun")
+    with section:
+        if not section.open:
+            return
+        
+        index = get_comment_view(data_version, data_dict)
+        meal_types = sorted(index['docs']['meal_type'].dropna().astype(str).unique().tolist())
+        
+        col1, col2 = st.columns([1, 2])
+        with col1:
+            meal_choice = st.selectbox("Тип блюда", ["Все блюда"] + meal_types, key="comments_meal_type")
+        with col2:
+            query = st.text_input("Поиск по комментариям", key="comments_query", placeholder="например: холодный суп")
+        meal_type = None if meal_choice == "Все блюда" else meal_choice
+        mask = filter_comment_docs(index, selected_class, date_range, meal_type)
+        
+        # Поиск: сразу исходные комментарии
+        if query.strip():
+            with timed('comment_search') as perf:
+                found = search_comments(index, query, mask)
+                perf['rows'] = len(found)
+            st.markdown(f"Найдено комментариев: **{len(found)}**")
+            if len(found):
+                st.dataframe(comment_rows(index, found), hide_index=True, width='stretch')
+            return
+        
+        top_terms = top_comment_terms(index, mask)
+        if top_terms.empty:
+            st.info("Нет комментариев с выбранными фильтрами")
+            return
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            fig_terms = cached_figure(
+                f'comment_terms:{meal_choice}', data_version, selected_class, date_range,
+                lambda: create_comment_terms_chart(top_terms)
+            )
+            show_chart(fig_terms, 'comment_terms')
+            st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #743014;"></div><span>Слова-жалобы среди самых частых слов</span></div></div>', unsafe_allow_html=True)
+        
+        complaints_by_day, complaints_by_group = complaint_stats(index, mask)
+        with col2:
+            fig_complaints = cached_figure(
+                f'comment_complaints:{meal_choice}', data_version, selected_class, date_range,
+                lambda: create_complaints_chart(complaints_by_day)
+            )
+            if fig_complaints:
+                show_chart(fig_complaints, 'comment_complaints')
+                st.markdown('<div class="graph-legend"><div class="legend-item"><div class="legend-color" style="background-color: #84592B;"></div><span>Сколько комментариев в день содержат жалобу</span></div></div>', unsafe_allow_html=True)
+            else:
+                st.info("Жалоб за выбранный период нет")
+        
+        if not complaints_by_group.empty:
+            st.markdown("**Комментарии с жалобами по классам и типам блюд**")
+            st.dataframe(complaints_by_group, width='stretch')
+        
+        # Переход от слова к исходным комментариям
+        term = st.selectbox("Показать комментарии со словом", top_terms['term'].tolist(), key="comments_term")
+        found = search_comments(index, term, mask)
+        st.dataframe(comment_rows(index, found), hide_index=True, width='stretch')
+
+def render_debug_panel(school=None):
+    """Замеры текущего перезапуска, счётчики кэшей, статистика загрузки и память школ"""
+    with st.sidebar:
+        with st.expander("Отладка: производительность", expanded=True):
+            records = getattr(_perf, 'records', None) or []
+            if records:
+                st.markdown("**Этапы перезапуска**")
+                st.dataframe(pd.DataFrame(records), hide_index=True)
+            
+            load_stats = get_sync_state(school)['load_stats']
+            if load_stats:
+                st.markdown("**Последняя загрузка из базы**")
+                st.dataframe(pd.DataFrame(load_stats).T, width='stretch')
+            
+            counters = get_perf_counters()
+            figures = cache_stats(get_figure_cache())
+            with counters['lock']:
+                cache_rows = [
+                    {'кэш': name, 'статус': status, 'раз': count}
+                    for (name, status), count in sorted(counters['counts'].items())
+                ]
+            cache_rows.append({'кэш': 'figures', 'статус': 'hit', 'раз': figures['hits']})
+            cache_rows.append({'кэш': 'figures', 'статус': 'miss', 'раз': figures['misses']})
+            cache_rows.append({'кэш': 'figures', 'статус': 'eviction', 'раз': figures['evictions']})
+            st.markdown("**Кэши**")
+            st.dataframe(pd.DataFrame(cache_rows), hide_index=True)
+            hit_rate = f"{figures['hit_rate']:.0%}" if figures['hit_rate'] is not None else "-"
+            st.caption(
+                f"Графики ({figures['policy']}): {figures['entries']} шт., "
+                f"{figures['bytes'] / 2**20:.1f} из {figures['budget'] / 2**20:.3g} МБ, попаданий {hit_rate}"
+            )
+            
+            registry = get_tenants()
+            with registry['lock']:
+                tenant_rows = [
+                    {'школа': school_name(key), 'МБ': round(tenant['bytes'] / 2**20, 1)}
+                    for key, tenant in registry['tenants'].items()
+                ]
+                evictions = registry['evictions']
+            st.markdown(f"**Школы в памяти** (лимит {TENANT_MEMORY_MB:g} МБ, выгружено: {evictions})")
+            st.dataframe(pd.DataFrame(tenant_rows), hide_index=True)
+
+def render_footer(name=DEFAULT_SCHOOL_NAME):
+    """Футер"""
     st.markdown("---")
     col1, col2, col3 = st.columns([1, 2, 1])
     
     with col2:
-        st.markdown("""
+        st.markdown(f"""
         <div style="text-align: center; color: #5D5D5D; font-size: 1.2rem;">
-            <p>Дашборд анализа школьного питания • Школа 64</p>
+            <p>Дашборд анализа школьного питания • {name}</p>
             <p>Данные собираются через <a href="https://t.me/foodschool64_bot" target="_blank">Telegram-бота</a></p>
         </div>
         """, unsafe_allow_html=True)
 
+# =============================================================================
+# ОСНОВНОЕ ПРИЛОЖЕНИЕ
+# =============================================================================
+def main():
+    debug_enabled = PERF_DEBUG or st.query_params.get('debug') == '1'
+    start_perf_session(debug_enabled)
+    
+    # Школа из адреса (?school=...), если дашборд обслуживает несколько школ
+    try:
+        school = selected_school()
+    except ValueError as e:
+        st.error(str(e))
+        return
+    
+    render_header(school_name(school))
+    
+    # Инициализация Supabase
+    source = init_data_source()
+    if not source:
+        st.error("Не удалось подключиться к базе данных. Проверьте файл .env")
+        return
+    
+    # Загрузка данных
+    with st.spinner('Загрузка данных...'):
+        with timed('load_real_data') as perf:
+            data_dict = load_real_data(source, school)
+            perf['cache'] = cache_status('load_real_data')
+    
+    if not data_dict:
+        return
+    
+    # Объединённые таблицы строятся один раз на версию данных
+    data_version = data_dict['version']
+    with timed('prepare_facts', rows=len(data_dict['surveys'])) as perf:
+        facts = get_facts(data_dict)
+        perf['cache'] = cache_status('prepare_facts')
+    survey_index = facts['survey_cube']
+    
+    # =========================================================================
+    # БОКОВАЯ ПАНЕЛЬ - ФИЛЬТРЫ
+    # =========================================================================
+    selected_class, date_range = render_sidebar(survey_index)
+    granularity = render_granularity_selector()
+    
+    # Применяем фильтры к кубу агрегатов
+    with timed('filter_cube') as perf:
+        filtered_cube = filter_cube(survey_index, selected_class, date_range)
+        perf['rows'] = len(filtered_cube)
+    total_surveys, avg_rating, max_rating = summarize_cube(filtered_cube)
+    render_sidebar_stats(total_surveys, avg_rating)
+    render_data_status(school)
+    
+    # Скользящие статистики дней - один раз на версию данных
+    with timed('day_anomalies'):
+        anomalies = get_day_anomalies(data_dict, facts)
+    
+    # Кубы недель, месяцев и четвертей - один раз на версию данных
+    with timed('time_pyramid'):
+        pyramid = get_time_pyramid(data_dict, facts)
+    
+    # =========================================================================
+    # РАЗДЕЛЫ
+    # =========================================================================
+    if not filtered_cube.empty:
+        render_bad_days(anomalies, selected_class, date_range)
+    render_summary(filtered_cube, total_surveys, avg_rating, max_rating)
+    
+    if not filtered_cube.empty:
+        render_rating_charts(
+            data_version, filtered_cube, anomalies, selected_class, date_range, granularity, pyramid[granularity]
+        )
+        render_meal_ratings_section(data_version, facts['rating_cube'], selected_class, date_range)
+        render_activity_section(data_version, pyramid[granularity], selected_class, date_range, granularity)
+        render_comments_section(data_version, data_dict, selected_class, date_range)
+    else:
+        st.warning("Нет данных для отображения с выбранными фильтрами")
+    
+    # =========================================================================
+    # ФУТЕР
+    # =========================================================================
+    render_footer(school_name(school))
+    
+    if debug_enabled:
+        render_debug_panel(school)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,34 @@
+# bench_common.py
+"""Общее для скриптов вокруг дашборда (benchmark.py, loadtest.py, reports.py):
+пути, порог регрессии, коммит прогона и тихий режим Streamlit.
+
+Без зависимостей от дашборда - нагрузочный тест не должен импортировать
+app.py ради пары констант.
+"""
+import logging
+import os
+import subprocess
+
+import streamlit.logger
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+RESULTS_DIR = 'bench_results'
+REGRESSION_THRESHOLD = 1.10  # на 10% медленнее - считаем регрессией
+
+def quiet_streamlit_logs():
+    """Streamlit без сервера пишет предупреждения на каждый вызов st.* - в скриптах они не нужны.
+    
+    Вызывать до import app: предупреждения идут уже при импорте.
+    """
+    streamlit.logger.set_log_level(logging.ERROR)
+
+def current_commit():
+    """Короткий хеш текущего коммита (или 'unknown' вне git)"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(APP_PATH)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
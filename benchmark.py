@@ -0,0 +1,267 @@
+# benchmark.py
+"""Бенчмарк дашборда на синтетических данных (без Supabase и без сети).
+
+Замеряет загрузку, подготовку фактов, нормализацию классов, агрегаты,
+каждую функцию create_* и полный перезапуск main() для нескольких
+объёмов данных. Для каждого шага пишет медианное время и пиковую память.
+
+    python benchmark.py --sizes 10000,100000,1000000
+    python benchmark.py --compare bench_results/<прошлый прогон>.json
+
+Результаты сохраняются в bench_results/<время>-<коммит>.json, чтобы
+сравнивать прогоны между коммитами.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+from bench_common import APP_PATH, REGRESSION_THRESHOLD, RESULTS_DIR, current_commit, quiet_streamlit_logs
+
+quiet_streamlit_logs()
+
+import app
+from data_sources import PostgrestCsvSource, SupabaseSource
+from synthetic_data import SyntheticSupabaseClient, generate_tables, serve_postgrest, write_tables
+
+def measure(func, repeat):
+    """Медианное время выполнения и пиковая память (отдельным прогоном под tracemalloc)"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return {
+        'seconds': round(statistics.median(timings), 6),
+        'peak_mb': round(peak / 2**20, 3)
+    }
+
+def clear_caches():
+    """Сбрасывает кэши Streamlit, чтобы каждый объём данных мерился с нуля"""
+    app.st.cache_data.clear()
+    app.st.cache_resource.clear()
+
+def bench_functions(tables, source, repeat):
+    """Замеры отдельных этапов обработки"""
+    results = {}
+    
+    results['load'] = measure(
+        lambda: app.fetch_tables(source, {table: None for table in app.SYNC_TABLES}), 1
+    )
+    frames, _ = app.fetch_tables(source, {table: None for table in app.SYNC_TABLES})
+    data_dict = dict(frames, version=1)
+    
+    # Колоночная загрузка: CSV по HTTP от локальной замены PostgREST.
+    # Сервер работает в том же процессе, а буферы pyarrow tracemalloc не видит -
+    # пиковая память этого шага только ориентир
+    server = serve_postgrest(tables)
+    try:
+        csv_source = PostgrestCsvSource(f"http://127.0.0.1:{server.server_port}", column_types=app.arrow_column_types())
+        results['load_csv'] = measure(
+            lambda: app.fetch_tables(csv_source, {table: None for table in app.SYNC_TABLES}), 1
+        )
+    finally:
+        server.shutdown()
+    
+    def prepare():
+        return app.prepare_facts(1, data_dict)
+    
+    results['prepare_facts'] = measure(prepare, repeat)
+    facts = prepare()
+    
+    merged = frames['surveys'].merge(frames['users'][['telegram_id', 'class']], on='telegram_id', how='left')
+    results['filter_and_normalize_classes'] = measure(lambda: app.filter_and_normalize_classes(merged), repeat)
+    
+    survey_index = facts['survey_cube']
+    rating_index = facts['rating_cube']
+    survey_cube = survey_index['frame']
+    first_class = app.CLASS_REGISTRY[0]
+    dates = survey_cube['date']
+    date_range = (dates.min().date(), (dates.min() + (dates.max() - dates.min()) / 2).date())
+    
+    anomalies = {
+        name: part['stats']
+        for name, part in app.update_day_anomalies(None, survey_cube, rating_index['frame']).items()
+    }
+    pyramid = app.update_time_pyramid(None, survey_cube)['levels']
+    
+    # Ряд средних по дням; бюджет меньше длины ряда, чтобы LTTB работал на любом объёме
+    daily = app.rollup(survey_cube, 'date')
+    budget = max(3, min(app.CHART_POINT_BUDGET, len(daily) // 2))
+    
+    def build_comment_index():
+        docs = app.comment_docs(frames['meal_comments'], frames['surveys'], frames['users'])
+        return app.extend_comment_index(app.empty_comment_index(), docs, 1, None, None, len(frames['meal_comments']))
+    
+    comment_index = build_comment_index()
+    comment_mask = app.filter_comment_docs(comment_index, "Все классы", date_range)
+    top_terms = app.top_comment_terms(comment_index, comment_mask)
+    complaints_by_day, _ = app.complaint_stats(comment_index, comment_mask)
+    
+    steps = {
+        'filter_cube': lambda: app.filter_cube(survey_index, first_class, date_range),
+        'update_day_anomalies': lambda: app.update_day_anomalies(None, survey_cube, rating_index['frame']),
+        'get_bad_days_stats': lambda: app.get_bad_days_stats(anomalies),
+        'get_daily_eating_statistics': lambda: app.get_daily_eating_statistics(survey_cube),
+        'create_daily_avg_ratings_chart': lambda: app.create_daily_avg_ratings_chart(
+            survey_cube, "Все классы", app.select_day_stats(anomalies['class_days'])
+        ),
+        'create_rating_distribution': lambda: app.create_rating_distribution(survey_cube, "Все классы"),
+        'create_class_comparison': lambda: app.create_class_comparison(survey_cube),
+        'create_meal_ratings_pie_charts': lambda: app.create_meal_ratings_pie_charts(rating_index, "Все классы", date_range),
+        'create_daily_surveys_chart': lambda: app.create_daily_surveys_chart(survey_index, "Все классы", date_range),
+        'update_time_pyramid': lambda: app.update_time_pyramid(None, survey_cube),
+        'lttb_indices': lambda: app.lttb_indices(
+            daily['date'].to_numpy().astype('datetime64[s]').astype('int64'), daily['avg_rating'].to_numpy(), budget
+        ),
+        'downsample_series': lambda: app.downsample_series(daily, 'date', 'avg_rating', budget),
+        'build_comment_index': build_comment_index,
+        'top_comment_terms': lambda: app.top_comment_terms(comment_index, comment_mask),
+        'complaint_stats': lambda: app.complaint_stats(comment_index, comment_mask),
+        'create_comment_terms_chart': lambda: app.create_comment_terms_chart(top_terms),
+        'create_complaints_chart': lambda: app.create_complaints_chart(complaints_by_day),
+    }
+    for granularity in ('week', 'month', 'term'):
+        level = pyramid[granularity]
+        steps[f'create_daily_avg_ratings_chart:{granularity}'] = (
+            lambda level=level, granularity=granularity:
+            app.create_daily_avg_ratings_chart(level['frame'], "Все классы", None, granularity)
+        )
+        steps[f'create_daily_surveys_chart:{granularity}'] = (
+            lambda level=level, granularity=granularity: app.create_daily_surveys_chart(
+                level, "Все классы", app.granularity_date_range(date_range, granularity), granularity
+            )
+        )
+    for name, step in steps.items():
+        results[name] = measure(step, repeat)
+    
+    return results
+
+def bench_main(tables, repeat):
+    """Полный перезапуск main() через streamlit.testing: холодный, повторный и со сменой класса.
+    
+    Приложение читает таблицы из локальных parquet (DATA_SOURCE=snapshot).
+    """
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    data_dir = os.path.join(work_dir, 'data')
+    write_tables(tables, data_dir)
+    env = {
+        'SNAPSHOT_DIR': os.path.join(work_dir, 'snapshot'),
+        'DATA_SOURCE': 'snapshot',
+        'DATA_SOURCE_PATH': data_dir
+    }
+    os.environ.update(env)
+    try:
+        clear_caches()
+        at = AppTest.from_file(APP_PATH, default_timeout=600)
+        
+        started = time.perf_counter()
+        at.run()
+        cold = time.perf_counter() - started
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        
+        results = {'main_cold': {'seconds': round(cold, 6), 'peak_mb': None}}
+        results['main_rerun'] = measure(at.run, repeat)
+        
+        class_box = at.selectbox[0]
+        options = class_box.options
+        
+        def change_class():
+            current = class_box.value
+            class_box.select(options[1] if current == options[0] else options[0]).run()
+        
+        results['main_filter_change'] = measure(change_class, repeat)
+        return results
+    finally:
+        for name in env:
+            os.environ.pop(name, None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(current, previous_path):
+    """Печатает изменение времени каждого шага относительно прошлого прогона"""
+    with open(previous_path, encoding='utf-8') as f:
+        previous = json.load(f)
+    
+    print(f"\nСравнение с {previous_path} (коммит {previous.get('commit')}):")
+    regressions = 0
+    for size, steps in current['results'].items():
+        for step, result in steps.items():
+            before = previous['results'].get(size, {}).get(step)
+            if not before or not before['seconds']:
+                continue
+            ratio = result['seconds'] / before['seconds']
+            mark = ''
+            if ratio > REGRESSION_THRESHOLD:
+                mark = '  <-- РЕГРЕССИЯ'
+                regressions += 1
+            print(f"  {size:>10} {step:<38} {before['seconds']:>10.4f} -> {result['seconds']:>10.4f} с  x{ratio:.2f}{mark}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк дашборда на синтетических данных")
+    parser.add_argument('--sizes', default='10000,100000',
+                        help="Число анкет через запятую (от 10000 до 10000000)")
+    parser.add_argument('--repeat', type=int, default=5, help="Повторов на шаг (берётся медиана)")
+    parser.add_argument('--skip-main', action='store_true', help="Не замерять полный перезапуск main()")
+    parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--output', help="Куда сохранить результаты (по умолчанию bench_results/)")
+    args = parser.parse_args()
+    
+    report = {
+        'commit': current_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'results': {}
+    }
+    
+    for size in [int(value) for value in args.sizes.split(',')]:
+        print(f"Объём: {size} анкет")
+        tables = generate_tables(size)
+        source = SupabaseSource(SyntheticSupabaseClient(tables))
+        
+        clear_caches()
+        results = bench_functions(tables, source, args.repeat)
+        if not args.skip_main:
+            results.update(bench_main(tables, args.repeat))
+        
+        for step, result in results.items():
+            peak = f"{result['peak_mb']:.1f} МБ" if result['peak_mb'] is not None else '-'
+            print(f"  {step:<38} {result['seconds']:>10.4f} с  {peak:>12}")
+        report['results'][str(size)] = results
+    
+    # ru_maxrss в Linux - в килобайтах
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{report['commit']}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nПиковый RSS процесса: {report['max_rss_mb']} МБ")
+    print(f"Результаты сохранены в {output}")
+    
+    if args.compare:
+        regressions = compare(report, args.compare)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
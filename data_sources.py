@@ -0,0 +1,307 @@
+# data_sources.py
+"""Источники данных дашборда.
+
+Дашборд читает таблицы постранично через один метод источника:
+
+    source.fetch_page(table, columns, watermark_column, since, start, end, with_count, tenant)
+    -> (строки как список словарей, общее число строк или None)
+
+tenant - фильтр по школе (или None - все строки):
+    {'column': 'school_id', 'value': '64'}                      - колонка самой таблицы;
+    {'column': 'school_id', 'value': '64',
+     'parent': 'surveys', 'key': 'survey_id'}                   - через родительскую таблицу.
+
+fetch_page может вернуть и pyarrow.Table вместо списка словарей - так
+делает колоночный источник, разбирающий ответ сразу в типизированные колонки.
+
+Реализации:
+- SupabaseSource - живая база через клиент Supabase;
+- PostgrestCsvSource - живая база напрямую по HTTP, ответы в CSV (pyarrow.csv);
+- SnapshotSource - локальные файлы <таблица>.parquet или <таблица>.json;
+- RecordingSource - обёртка над любым источником, записывающая ответы на диск;
+- ReplaySource - воспроизведение записанных ответов без сети.
+
+Локальные источники умеют добавлять искусственную задержку на каждый запрос,
+чтобы профилировать загрузку в условиях, похожих на реальную сеть.
+Источник выбирается переменной DATA_SOURCE (см. create_data_source).
+"""
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+RECORDING_FILE = 'recording.jsonl'
+
+def request_key(table, columns, watermark_column, since, start, end, with_count, tenant=None):
+    """Ключ запроса для записи и воспроизведения"""
+    key = [table, columns, watermark_column, since, start, end, bool(with_count)]
+    if tenant:
+        # Без фильтра ключ прежний - старые записи остаются в силе
+        key.append(tenant)
+    return json.dumps(key, ensure_ascii=False, default=str, sort_keys=True)
+
+def to_records(page):
+    """Строки страницы в JSON-подобном виде (даты - строками, как отдаёт PostgREST)"""
+    page = page.copy()
+    for column in page.columns:
+        if pd.api.types.is_datetime64_any_dtype(page[column]):
+            page[column] = page[column].dt.strftime('%Y-%m-%d')
+    page = page.astype(object).where(page.notna(), None)
+    return page.to_dict('records')
+
+def page_order(watermark_column):
+    """Колонки сортировки страниц.
+    
+    Стабильный порядок нужен, чтобы страницы не пересекались и не теряли строки:
+    сортируем по водяному знаку, а при неуникальном знаке (время изменения) ещё и по id.
+    """
+    return [watermark_column] if watermark_column == 'id' else [watermark_column, 'id']
+
+def postgrest_select(columns, tenant=None):
+    """select и фильтр по школе в синтаксисе PostgREST.
+    
+    Возвращает (select, (колонка фильтра, значение) или None, родитель или None).
+    Фильтр через родительскую таблицу - внутреннее соединение PostgREST:
+    родитель добавляется в select как родитель!inner(колонка), и его колонку
+    из ответа нужно убрать.
+    """
+    select = ",".join(columns)
+    if not tenant:
+        return select, None, None
+    parent = tenant.get('parent')
+    if parent:
+        return select + f",{parent}!inner({tenant['column']})", (f"{parent}.{tenant['column']}", tenant['value']), parent
+    return select, (tenant['column'], tenant['value']), None
+
+class SupabaseSource:
+    """Живая база: запросы через клиент Supabase (или совместимую заглушку)"""
+    def __init__(self, client):
+        self.client = client
+    
+    def fetch_page(self, table, columns, watermark_column, since, start, end, with_count=False, tenant=None):
+        select, tenant_eq, parent = postgrest_select(columns, tenant)
+        query = self.client.table(table).select(select, count="exact" if with_count else None)
+        if tenant_eq:
+            query = query.eq(*tenant_eq)
+        if since is not None:
+            query = query.gt(watermark_column, since)
+        for column in page_order(watermark_column):
+            query = query.order(column)
+        response = query.range(start, end).execute()
+        rows = response.data
+        if parent:
+            for row in rows:
+                row.pop(parent, None)
+        return rows, getattr(response, 'count', None)
+
+def content_range_total(header):
+    """Общее число строк из заголовка Content-Range ('0-999/12345'; '*' - неизвестно)"""
+    if not header or '/' not in header:
+        return None
+    total = header.rsplit('/', 1)[1]
+    return int(total) if total.isdigit() else None
+
+class PostgrestCsvSource:
+    """Живая база через REST API PostgREST с ответом в CSV (Accept: text/csv).
+    
+    Страница не превращается в список словарей: pyarrow.csv читает её прямо
+    из ответа в колонки нужных типов, и fetch_page возвращает pyarrow.Table.
+    column_types - {таблица: {колонка: тип pyarrow}}; колонки без типа
+    определяются по данным.
+    """
+    def __init__(self, url, key=None, column_types=None, timeout=60):
+        self.url = url.rstrip('/') + '/rest/v1'
+        self.headers = {'apikey': key, 'Authorization': f"Bearer {key}"} if key else {}
+        self.column_types = column_types or {}
+        self.timeout = timeout
+    
+    def convert_options(self, table, columns):
+        # Postgres пишет логические значения как t/f, NULL - пустым полем без кавычек
+        return pa_csv.ConvertOptions(
+            column_types={
+                column: dtype for column, dtype in self.column_types.get(table, {}).items()
+                if column in columns
+            },
+            true_values=['t', 'true'],
+            false_values=['f', 'false'],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False
+        )
+    
+    def empty_page(self, table, columns):
+        types = self.column_types.get(table, {})
+        return pa.table({column: pa.array([], type=types.get(column, pa.string())) for column in columns})
+    
+    def fetch_page(self, table, columns, watermark_column, since, start, end, with_count=False, tenant=None):
+        select, tenant_eq, parent = postgrest_select(columns, tenant)
+        params = [('select', select)]
+        if tenant_eq:
+            params.append((tenant_eq[0], f"eq.{tenant_eq[1]}"))
+        if since is not None:
+            params.append((watermark_column, f"gt.{since}"))
+        params.append(('order', ",".join(page_order(watermark_column))))
+        
+        headers = dict(self.headers, Accept='text/csv', Range=f"{start}-{end}")
+        headers['Range-Unit'] = 'items'
+        if with_count:
+            headers['Prefer'] = 'count=exact'
+        request = urllib.request.Request(f"{self.url}/{table}?{urlencode(params)}", headers=headers)
+        
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                total = content_range_total(response.headers.get('Content-Range'))
+                try:
+                    page = pa_csv.read_csv(response, convert_options=self.convert_options(table, columns))
+                except pa.ArrowInvalid as e:
+                    # Пустой ответ (без строк и заголовка); остальные ошибки разбора - настоящие
+                    if 'Empty CSV' not in str(e):
+                        raise
+                    page = self.empty_page(table, columns)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # Диапазон за концом таблицы - строк нет
+            total = content_range_total(e.headers.get('Content-Range'))
+            page = self.empty_page(table, columns)
+        
+        if parent and parent in page.column_names:
+            page = page.drop_columns([parent])
+        return page, total if with_count else None
+
+class LocalSource:
+    """Общая часть локальных источников: искусственная задержка запроса"""
+    def __init__(self, latency_ms=0):
+        self.latency = max(latency_ms, 0) / 1000
+    
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+class SnapshotSource(LocalSource):
+    """Таблицы из локальных файлов <таблица>.parquet или <таблица>.json.
+    
+    JSON - список строк в том виде, в каком их отдаёт PostgREST.
+    Страницы режутся так же, как на сервере: фильтр по водяному знаку,
+    сортировка, диапазон строк и не больше row_cap строк за запрос.
+    """
+    def __init__(self, path, latency_ms=0, row_cap=1000):
+        super().__init__(latency_ms)
+        self.path = path
+        self.row_cap = row_cap
+        self.tables = {}
+        self.tenant_tables = {}
+        self.lock = threading.Lock()
+    
+    def read_table(self, table):
+        with self.lock:
+            if table not in self.tables:
+                parquet_path = os.path.join(self.path, f"{table}.parquet")
+                json_path = os.path.join(self.path, f"{table}.json")
+                if os.path.exists(parquet_path):
+                    df = pd.read_parquet(parquet_path)
+                elif os.path.exists(json_path):
+                    with open(json_path, encoding='utf-8') as f:
+                        df = pd.DataFrame(json.load(f))
+                else:
+                    raise FileNotFoundError(f"Нет файла таблицы {table} в {self.path}")
+                self.tables[table] = df
+            return self.tables[table]
+    
+    def tenant_table(self, table, tenant):
+        """Строки одной школы (отбираются один раз на таблицу и школу)"""
+        key = (table, json.dumps(tenant, sort_keys=True, default=str))
+        if key not in self.tenant_tables:
+            df = self.read_table(table)
+            if tenant.get('parent'):
+                parent = self.read_table(tenant['parent'])
+                ids = parent.loc[parent[tenant['column']].astype(str) == str(tenant['value']), 'id']
+                df = df[df[tenant['key']].isin(ids)]
+            else:
+                df = df[df[tenant['column']].astype(str) == str(tenant['value'])]
+            with self.lock:
+                self.tenant_tables[key] = df
+        return self.tenant_tables[key]
+    
+    def fetch_page(self, table, columns, watermark_column, since, start, end, with_count=False, tenant=None):
+        self.wait()
+        df = self.tenant_table(table, tenant) if tenant else self.read_table(table)
+        if since is not None:
+            df = df[df[watermark_column] > since]
+        if not df[watermark_column].is_monotonic_increasing or watermark_column != 'id':
+            df = df.sort_values(page_order(watermark_column), kind='stable')
+        
+        total = len(df)
+        page = df.iloc[start:min(end + 1, start + self.row_cap)]
+        page = page[[column for column in columns if column in page.columns]]
+        return to_records(page), total if with_count else None
+
+class RecordingSource:
+    """Пропускает запросы к другому источнику и дописывает ответы в recording.jsonl"""
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+    
+    def fetch_page(self, table, columns, watermark_column, since, start, end, with_count=False, tenant=None):
+        rows, total = self.inner.fetch_page(table, columns, watermark_column, since, start, end, with_count, tenant)
+        record = {
+            'key': request_key(table, columns, watermark_column, since, start, end, with_count, tenant),
+            'rows': rows,
+            'total': total
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.lock:
+            with open(os.path.join(self.path, RECORDING_FILE), 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        return rows, total
+
+class ReplaySource(LocalSource):
+    """Воспроизводит ответы, записанные RecordingSource.
+    
+    Повторный запрос с тем же ключом получает последний записанный ответ.
+    Незаписанный запрос дельты (since задан) считается пустым - новых строк нет;
+    незаписанная полная загрузка - ошибка записи.
+    """
+    def __init__(self, path, latency_ms=0):
+        super().__init__(latency_ms)
+        self.responses = {}
+        with open(os.path.join(path, RECORDING_FILE), encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[record['key']] = (record['rows'], record['total'])
+    
+    def fetch_page(self, table, columns, watermark_column, since, start, end, with_count=False, tenant=None):
+        self.wait()
+        key = request_key(table, columns, watermark_column, since, start, end, with_count, tenant)
+        if key in self.responses:
+            return self.responses[key]
+        if since is not None:
+            return [], 0 if with_count else None
+        raise KeyError(f"В записи нет ответа на запрос {key}")
+
+def create_data_source(kind, path=None, latency_ms=0, client_factory=None, url=None, key=None, column_types=None):
+    """Источник по имени: supabase, csv, snapshot, record или replay.
+    
+    client_factory - функция без аргументов, создающая клиент Supabase
+    (нужна для supabase и record); url, key и column_types - для csv.
+    """
+    if kind == 'supabase':
+        return SupabaseSource(client_factory())
+    if kind == 'csv':
+        return PostgrestCsvSource(url, key, column_types)
+    if kind == 'snapshot':
+        return SnapshotSource(path, latency_ms)
+    if kind == 'record':
+        return RecordingSource(SupabaseSource(client_factory()), path)
+    if kind == 'replay':
+        return ReplaySource(path, latency_ms)
+    raise ValueError(f"Неизвестный источник данных: {kind}")
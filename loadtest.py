@@ -0,0 +1,315 @@
+# loadtest.py
+"""Нагрузочный тест: N одновременных сессий дашборда.
+
+Поднимает локальный `streamlit run app.py` на синтетических данных (parquet,
+DATA_SOURCE=snapshot) и подключает к нему N безголовых клиентов по тому же
+websocket-протоколу, что и браузер. Каждый клиент открывает страницу, а затем
+случайно меняет класс и период. Для каждого числа сессий печатает p50/p95/p99
+времени перезапуска, пропускную способность (перезапусков в секунду) и
+прирост RSS процесса сервера на одну сессию.
+
+    python loadtest.py --sessions 1,10,50 --actions 20
+    python loadtest.py --url ws://localhost:8501 --sessions 20   # уже запущенный сервер
+    python loadtest.py --compare bench_results/<прошлый прогон>.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+try:
+    from websockets.sync.client import connect
+except ImportError:
+    connect = None
+
+from bench_common import APP_PATH, REGRESSION_THRESHOLD, RESULTS_DIR, current_commit
+from synthetic_data import generate_tables, write_tables
+
+SERVER_START_TIMEOUT = 60
+
+# =============================================================================
+# СЕРВЕР
+# =============================================================================
+def free_port():
+    """Свободный локальный порт"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(data_dir, work_dir):
+    """Запускает дашборд на локальных parquet и ждёт готовности. Возвращает (процесс, порт)"""
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATA_SOURCE='snapshot',
+        DATA_SOURCE_PATH=data_dir,
+        SNAPSHOT_DIR=os.path.join(work_dir, 'snapshot')
+    )
+    log = open(os.path.join(work_dir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'streamlit', 'run', APP_PATH,
+            '--server.headless', 'true',
+            '--server.port', str(port),
+            '--server.enableXsrfProtection', 'false',
+            '--browser.gatherUsageStats', 'false'
+        ],
+        env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился при запуске, см. {log.name}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Сервер не ответил за отведённое время")
+
+def process_rss_mb(pid):
+    """RSS процесса в МБ (None, если недоступен - например, у внешнего сервера)"""
+    if pid is None:
+        return None
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+# =============================================================================
+# КЛИЕНТ
+# =============================================================================
+class Session:
+    """Безголовый клиент: шлёт rerun_script с состоянием виджетов и ждёт script_finished"""
+    def __init__(self, url):
+        self.ws = connect(f"{url}/_stcore/stream", subprotocols=["streamlit"], max_size=None)
+        self.widgets = {}
+        self.states = {}
+    
+    def rerun(self):
+        """Один перезапуск страницы; возвращает время до конца скрипта в секундах"""
+        message = BackMsg()
+        message.rerun_script.widget_states.widgets.extend(self.states.values())
+        
+        started = time.perf_counter()
+        self.ws.send(message.SerializeToString())
+        widgets = {}
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(self.ws.recv())
+            kind = forward.WhichOneof('type')
+            if kind == 'delta' and forward.delta.WhichOneof('type') == 'new_element':
+                element = forward.delta.new_element
+                element_type = element.WhichOneof('type')
+                if element_type == 'exception':
+                    raise RuntimeError(element.exception.message)
+                if element_type in ('selectbox', 'date_input'):
+                    widgets[element_type] = getattr(element, element_type)
+            elif kind == 'script_finished':
+                elapsed = time.perf_counter() - started
+                break
+        
+        # id поля периода зависит от его границ - держим только актуальные виджеты
+        self.widgets = widgets
+        self.states = {
+            name: state for name, state in self.states.items()
+            if name in widgets and state.id == widgets[name].id
+        }
+        return elapsed
+    
+    def select_class(self, rng):
+        selectbox = self.widgets['selectbox']
+        self.states['selectbox'] = WidgetState(id=selectbox.id, string_value=rng.choice(list(selectbox.options)))
+    
+    def select_dates(self, rng):
+        date_input = self.widgets['date_input']
+        first, last = date.fromisoformat(date_input.min), date.fromisoformat(date_input.max)
+        start = first + timedelta(days=rng.randint(0, (last - first).days))
+        end = start + timedelta(days=rng.randint(0, (last - start).days))
+        state = WidgetState(id=date_input.id)
+        state.string_array_value.data[:] = [start.isoformat(), end.isoformat()]
+        self.states['date_input'] = state
+    
+    def close(self):
+        self.ws.close()
+
+def drive_session(session, actions, think_time, seed, latencies, lock):
+    """Сценарий пользователя: случайно меняет класс или период"""
+    rng = random.Random(seed)
+    for _ in range(actions):
+        if think_time:
+            time.sleep(rng.uniform(0, think_time))
+        
+        # Без данных у класса поля периода нет - тогда снова меняем класс
+        if rng.random() < 0.5 or 'date_input' not in session.widgets:
+            session.select_class(rng)
+        else:
+            session.select_dates(rng)
+        elapsed = session.rerun()
+        with lock:
+            latencies.append(elapsed)
+
+# =============================================================================
+# ПРОГОН
+# =============================================================================
+def percentiles(values):
+    """p50/p95/p99 в секундах"""
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(float(p50), 4), 'p95': round(float(p95), 4), 'p99': round(float(p99), 4)}
+
+def run_level(url, pid, n_sessions, actions, think_time):
+    """Один уровень нагрузки: n_sessions сессий одновременно"""
+    lock = threading.Lock()
+    open_latencies = []
+    rerun_latencies = []
+    
+    def open_session(_):
+        session = Session(url)
+        elapsed = session.rerun()
+        with lock:
+            open_latencies.append(elapsed)
+        return session
+    
+    rss_before = process_rss_mb(pid)
+    with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+        sessions = list(executor.map(open_session, range(n_sessions)))
+        
+        started = time.perf_counter()
+        futures = [
+            executor.submit(drive_session, session, actions, think_time, seed, rerun_latencies, lock)
+            for seed, session in enumerate(sessions)
+        ]
+        for future in futures:
+            future.result()
+        wall = time.perf_counter() - started
+        # Замер до отключения: сессии ещё живы и держат своё состояние
+        rss_after = process_rss_mb(pid)
+    
+    for session in sessions:
+        session.close()
+    
+    per_session = None
+    if rss_before is not None and rss_after is not None:
+        per_session = round((rss_after - rss_before) / n_sessions, 2)
+    return {
+        'sessions': n_sessions,
+        'open': percentiles(open_latencies),
+        'rerun': percentiles(rerun_latencies),
+        'reruns': len(rerun_latencies),
+        'throughput': round(len(rerun_latencies) / wall, 2) if wall else None,
+        'rss_mb': round(rss_after, 1) if rss_after is not None else None,
+        'rss_per_session_mb': per_session
+    }
+
+def compare(current, previous_path):
+    """Печатает изменение p95 перезапуска относительно прошлого прогона"""
+    with open(previous_path, encoding='utf-8') as f:
+        previous = json.load(f)
+    
+    print(f"\nСравнение с {previous_path} (коммит {previous.get('commit')}):")
+    before_by_level = {level['sessions']: level for level in previous['levels']}
+    regressions = 0
+    for level in current['levels']:
+        before = before_by_level.get(level['sessions'])
+        if not before or not before['rerun']['p95']:
+            continue
+        ratio = level['rerun']['p95'] / before['rerun']['p95']
+        mark = ''
+        if ratio > REGRESSION_THRESHOLD:
+            mark = '  <-- РЕГРЕССИЯ'
+            regressions += 1
+        print(f"  {level['sessions']:>4} сессий  p95 {before['rerun']['p95']:>8.4f} -> {level['rerun']['p95']:>8.4f} с  x{ratio:.2f}{mark}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест дашборда: одновременные сессии")
+    parser.add_argument('--sessions', default='1,10', help="Число одновременных сессий через запятую")
+    parser.add_argument('--actions', type=int, default=10, help="Смен фильтров на сессию")
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help="Максимальная пауза между действиями пользователя, с")
+    parser.add_argument('--surveys', type=int, default=100_000, help="Объём синтетических данных (анкет)")
+    parser.add_argument('--url', help="Адрес уже запущенного сервера (ws://host:port); RSS тогда не замеряется")
+    parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--output', help="Куда сохранить результаты (по умолчанию bench_results/)")
+    args = parser.parse_args()
+    
+    if connect is None:
+        sys.exit("Для нагрузочного теста нужен пакет websockets: pip install websockets")
+    
+    report = {
+        'commit': current_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'surveys': None if args.url else args.surveys,
+        'actions': args.actions,
+        'think_time': args.think_time,
+        'pandas': pd.__version__,
+        'levels': []
+    }
+    
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    process = None
+    try:
+        if args.url:
+            url, pid = args.url.rstrip('/'), None
+        else:
+            data_dir = os.path.join(work_dir, 'data')
+            write_tables(generate_tables(args.surveys), data_dir)
+            process, port = start_server(data_dir, work_dir)
+            url, pid = f"ws://127.0.0.1:{port}", process.pid
+        
+        # Прогрев: данные и кэши загружаются один раз, дальше меряем только сессии
+        warmup = Session(url)
+        warmup.rerun()
+        warmup.close()
+        
+        for n_sessions in [int(value) for value in args.sessions.split(',')]:
+            level = run_level(url, pid, n_sessions, args.actions, args.think_time)
+            report['levels'].append(level)
+            rss = f", RSS {level['rss_mb']} МБ ({level['rss_per_session_mb']:+} МБ на сессию)" if pid else ""
+            print(
+                f"{n_sessions:>4} сессий: перезапуск p50 {level['rerun']['p50']} / p95 {level['rerun']['p95']} / "
+                f"p99 {level['rerun']['p99']} с, {level['throughput']} перезапусков/с{rss}"
+            )
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"loadtest-{time.strftime('%Y%m%d-%H%M%S')}-{report['commit']}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+    
+    if args.compare:
+        regressions = compare(report, args.compare)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
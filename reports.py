@@ -0,0 +1,319 @@
+# reports.py
+"""Пакетная выгрузка отчётов без интерактивного сервера.
+
+Загружает данные тем же источником, что и дашборд (DATA_SOURCE), один раз
+считает факты, кубы, статистики дней и индекс комментариев, а затем в пуле
+процессов строит отчёт для каждого класса и периода теми же функциями create_*.
+Для каждого отчёта пишется папка <период>/<класс>/:
+
+    index.html        - страница с метриками и графиками (без сервера и сети)
+    figures/*.json    - графики в формате Plotly (и *.png с --png, нужен kaleido)
+    aggregates.csv    - срез куба: дата × класс × оценка, количество и суммы
+    daily.csv         - средняя оценка и обычный коридор по дням
+    bad_days.csv      - аномальные дни
+
+В корне - общий index.html, summary.csv с метриками всех отчётов и plotly.min.js.
+
+    python reports.py --period week --last 1 --output reports
+    python reports.py --period month --last 3 --workers 4 --png
+    python reports.py --from-snapshot          # последний снимок дашборда, без запросов к базе
+    python reports.py --school 12              # одна из школ SCHOOLS
+"""
+import argparse
+import html
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import plotly.offline
+
+try:
+    import kaleido
+except ImportError:
+    kaleido = None
+
+from bench_common import quiet_streamlit_logs
+
+quiet_streamlit_logs()
+
+import app
+
+ALL_CLASSES = "Все классы"
+# Файлы круговых диаграмм - в порядке create_meal_ratings_pie_charts: первое, второе, напиток
+MEAL_CHART_NAMES = ['meal_ratings_first', 'meal_ratings_second', 'meal_ratings_drink']
+
+# =============================================================================
+# ДАННЫЕ
+# =============================================================================
+def load_tables(from_snapshot, school=None):
+    """Таблицы школы из источника дашборда или из последнего снимка на диске"""
+    if from_snapshot:
+        snapshot = app.load_snapshot(school)
+        if snapshot is None:
+            raise RuntimeError(f"Нет снимка данных в {app.school_snapshot_dir(school)}")
+        return dict(snapshot['frames'], school=school, version=snapshot['version'])
+    
+    source = app.new_data_source()
+    frames, _ = app.fetch_tables(source, {table: None for table in app.SYNC_TABLES}, school)
+    return dict(frames, school=school, version=1)
+
+def build_context(data_dict):
+    """Всё, что нужно для отчётов, считается один раз и передаётся в процессы пула.
+    
+    Используются только кубы и индексы - они в сотни раз меньше исходных таблиц.
+    Факты считаются pandas: соединение DuckDB нельзя передать в другой процесс.
+    """
+    facts = app.prepare_facts(data_dict['version'], data_dict)
+    anomalies = {
+        name: part['stats']
+        for name, part in app.update_day_anomalies(
+            None, facts['survey_cube']['frame'], facts['rating_cube']['frame']
+        ).items()
+    }
+    comments = data_dict['meal_comments']
+    comment_index = app.extend_comment_index(
+        app.empty_comment_index(),
+        app.comment_docs(comments, data_dict['surveys'], data_dict['users']),
+        data_dict['version'], None, app.get_watermark(comments, 'id'), len(comments)
+    )
+    return {
+        'survey_cube': facts['survey_cube'],
+        'rating_cube': facts['rating_cube'],
+        'anomalies': anomalies,
+        'comment_index': comment_index
+    }
+
+def report_periods(dates, period, last):
+    """Периоды отчётов: [(имя папки, название, (первый день, последний день))]"""
+    first, final = dates.min(), dates.max()
+    if period == 'all':
+        return [('all', "Весь период", (first.date(), final.date()))]
+    
+    periods = pd.period_range(first, final, freq='W-SUN' if period == 'week' else 'M')[-last:]
+    result = []
+    for p in periods:
+        start, end = p.start_time.date(), p.end_time.date()
+        if period == 'week':
+            result.append((f"week-{start:%Y-%m-%d}", f"Неделя {start:%d.%m.%Y} - {end:%d.%m.%Y}", (start, end)))
+        else:
+            result.append((f"month-{start:%Y-%m}", f"Месяц {start:%m.%Y}", (start, end)))
+    return result
+
+def report_classes(survey_cube):
+    """Все классы вместе и каждый класс, у которого есть анкеты"""
+    classes = app.rollup(survey_cube, 'class').sort_values('count', ascending=False)['class']
+    return [ALL_CLASSES] + [str(cls) for cls in classes]
+
+# =============================================================================
+# ОДИН ОТЧЁТ (В ПРОЦЕССЕ ПУЛА)
+# =============================================================================
+_context = None
+
+def init_worker(context):
+    """Данные отчётов передаются в каждый процесс один раз, а не с каждой задачей"""
+    global _context
+    _context = context
+    quiet_streamlit_logs()
+
+def class_folder(selected_class):
+    return 'all' if selected_class == ALL_CLASSES else selected_class
+
+def report_figures(selected_class, date_range, filtered_cube):
+    """Графики отчёта: {имя файла: фигура}, как в разделах дашборда"""
+    survey_index = _context['survey_cube']
+    anomalies = _context['anomalies']
+    figures = {
+        'daily_avg_ratings': app.create_daily_avg_ratings_chart(
+            filtered_cube, selected_class,
+            app.select_day_stats(anomalies['class_days'], selected_class, date_range)
+        ),
+        'rating_distribution': app.create_rating_distribution(filtered_cube, selected_class),
+        'class_comparison': app.create_class_comparison(filtered_cube),
+        'daily_surveys': app.create_daily_surveys_chart(survey_index, selected_class, date_range)
+    }
+    
+    pie_charts = app.create_meal_ratings_pie_charts(_context['rating_cube'], selected_class, date_range)
+    for name, fig in zip(MEAL_CHART_NAMES, pie_charts or []):
+        figures[name] = fig
+    
+    index = _context['comment_index']
+    mask = app.filter_comment_docs(index, selected_class, date_range)
+    top_terms = app.top_comment_terms(index, mask)
+    if not top_terms.empty:
+        figures['comment_terms'] = app.create_comment_terms_chart(top_terms)
+        figures['comment_complaints'] = app.create_complaints_chart(app.complaint_stats(index, mask)[0])
+    
+    return {name: fig for name, fig in figures.items() if fig is not None}
+
+def report_metrics(filtered_cube):
+    """Основные метрики раздела «Общая статистика»"""
+    total_surveys, avg_rating, max_rating = app.summarize_cube(filtered_cube)
+    eats_count, not_eat_count, _ = app.get_eating_statistics(filtered_cube)
+    return {
+        'surveys': total_surveys,
+        'avg_rating': None if avg_rating is None else round(float(avg_rating), 2),
+        'max_rating': None if max_rating is None else int(max_rating),
+        'active_classes': int(filtered_cube['class'].nunique()) if not filtered_cube.empty else 0,
+        'eats_count': eats_count,
+        'not_eat_count': not_eat_count
+    }
+
+def render_report_html(title, metrics, bad_days, figures):
+    """Статическая страница отчёта; plotly.min.js лежит в корне выгрузки"""
+    metric_names = {
+        'surveys': "Всего анкет",
+        'avg_rating': "Средняя оценка",
+        'max_rating': "Максимальная оценка",
+        'active_classes': "Активных классов",
+        'eats_count': "Питались при подаче анкеты",
+        'not_eat_count': "Не питались при подаче анкеты"
+    }
+    rows = ''.join(
+        f"<tr><td>{metric_names[name]}</td><td>{'-' if value is None else value}</td></tr>"
+        for name, value in metrics.items()
+    )
+    bad_days_html = bad_days.to_html(index=False, border=0) if not bad_days.empty else "<p>Аномальных дней нет</p>"
+    charts = ''.join(
+        fig.to_html(full_html=False, include_plotlyjs=False, config={'displayModeBar': False})
+        for fig in figures.values()
+    )
+    return f"""<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<script src="../../plotly.min.js"></script>
+</head>
+<body style="font-family: sans-serif; color: #442D1C; max-width: 1200px; margin: auto;">
+<h1>{html.escape(title)}</h1>
+<table>{rows}</table>
+<h2>Аномальные дни</h2>
+{bad_days_html}
+<h2>Графики</h2>
+{charts}
+</body>
+</html>
+"""
+
+def build_report(task):
+    """Строит и сохраняет отчёт одного класса за один период; возвращает строку сводки"""
+    output, period_folder, period_title, date_range, selected_class, with_png = task
+    started = time.perf_counter()
+    report_dir = os.path.join(output, period_folder, class_folder(selected_class))
+    figures_dir = os.path.join(report_dir, 'figures')
+    os.makedirs(figures_dir, exist_ok=True)
+    
+    filtered_cube = app.filter_cube(_context['survey_cube'], selected_class, date_range)
+    metrics = report_metrics(filtered_cube)
+    figures = report_figures(selected_class, date_range, filtered_cube) if not filtered_cube.empty else {}
+    
+    day_stats = app.select_day_stats(_context['anomalies']['class_days'], selected_class, date_range)
+    bad_days = pd.DataFrame(app.get_bad_days_stats(_context['anomalies'], selected_class, date_range))
+    
+    filtered_cube.to_csv(os.path.join(report_dir, 'aggregates.csv'), index=False)
+    day_stats.to_csv(os.path.join(report_dir, 'daily.csv'), index=False)
+    bad_days.to_csv(os.path.join(report_dir, 'bad_days.csv'), index=False)
+    
+    for name, fig in figures.items():
+        fig.write_json(os.path.join(figures_dir, f"{name}.json"))
+        if with_png:
+            fig.write_image(os.path.join(figures_dir, f"{name}.png"), width=1200, height=600)
+    
+    title = f"{selected_class} - {period_title}"
+    with open(os.path.join(report_dir, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(render_report_html(title, metrics, bad_days, figures))
+    
+    return {
+        'period': period_folder,
+        'class': selected_class,
+        'start': date_range[0].isoformat(),
+        'end': date_range[1].isoformat(),
+        **metrics,
+        'bad_days': len(bad_days),
+        'figures': len(figures),
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+# =============================================================================
+# ВЫГРУЗКА
+# =============================================================================
+def write_index(output, summary, name):
+    """Общая страница со ссылками на все отчёты"""
+    rows = ''.join(
+        f"<tr><td>{html.escape(row['period'])}</td>"
+        f"<td><a href=\"{html.escape(row['period'])}/{html.escape(class_folder(row['class']))}/index.html\">"
+        f"{html.escape(row['class'])}</a></td>"
+        f"<td>{row['surveys']}</td><td>{'-' if row['avg_rating'] is None else row['avg_rating']}</td>"
+        f"<td>{row['bad_days']}</td></tr>"
+        for row in summary
+    )
+    with open(os.path.join(output, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(f"""<!DOCTYPE html>
+<html lang="ru">
+<head><meta charset="utf-8"><title>Отчёты по школьному питанию</title></head>
+<body style="font-family: sans-serif; color: #442D1C; max-width: 1200px; margin: auto;">
+<h1>Отчёты по школьному питанию • {html.escape(name)}</h1>
+<table>
+<tr><th>Период</th><th>Класс</th><th>Анкет</th><th>Средняя оценка</th><th>Аномальных дней</th></tr>
+{rows}
+</table>
+</body>
+</html>
+""")
+
+def main():
+    parser = argparse.ArgumentParser(description="Статические отчёты дашборда по классам и периодам")
+    parser.add_argument('--period', choices=['week', 'month', 'all'], default='week', help="Длина периода отчёта")
+    parser.add_argument('--last', type=int, default=1, help="Сколько последних периодов выгрузить")
+    parser.add_argument('--school', help="Школа из SCHOOLS (по умолчанию - режим одной школы)")
+    parser.add_argument('--classes', help="Классы через запятую (по умолчанию все классы и каждый класс)")
+    parser.add_argument('--output', default='reports', help="Папка выгрузки")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Процессов в пуле")
+    parser.add_argument('--png', action='store_true', help="Сохранять графики ещё и в PNG (нужен пакет kaleido)")
+    parser.add_argument('--from-snapshot', action='store_true',
+                        help="Брать данные из снимка дашборда (SNAPSHOT_DIR), не обращаясь к базе")
+    args = parser.parse_args()
+    
+    with_png = args.png
+    if with_png and kaleido is None:
+        print("Пакет kaleido не установлен (pip install kaleido) - PNG не сохраняются", file=sys.stderr)
+        with_png = False
+    
+    started = time.perf_counter()
+    if args.school and args.school not in app.SCHOOLS:
+        print(f"Неизвестная школа: {args.school}", file=sys.stderr)
+        sys.exit(1)
+    data_dict = load_tables(args.from_snapshot, args.school)
+    context = build_context(data_dict)
+    survey_cube = context['survey_cube']['frame']
+    if survey_cube.empty:
+        print("Нет анкет для отчётов", file=sys.stderr)
+        sys.exit(1)
+    print(f"Данные подготовлены за {time.perf_counter() - started:.1f} с: {len(data_dict['surveys'])} анкет")
+    
+    periods = report_periods(survey_cube['date'], args.period, args.last)
+    if args.classes:
+        classes = [cls.strip() for cls in args.classes.split(',') if cls.strip()]
+    else:
+        classes = report_classes(survey_cube)
+    
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, 'plotly.min.js'), 'w', encoding='utf-8') as f:
+        f.write(plotly.offline.get_plotlyjs())
+    
+    tasks = [
+        (args.output, period_folder, period_title, date_range, selected_class, with_png)
+        for period_folder, period_title, date_range in periods
+        for selected_class in classes
+    ]
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(context,)) as executor:
+        summary = list(executor.map(build_report, tasks))
+    
+    pd.DataFrame(summary).to_csv(os.path.join(args.output, 'summary.csv'), index=False)
+    write_index(args.output, summary, app.school_name(args.school))
+    print(f"Отчётов: {len(summary)}, папка {args.output}, всего {time.perf_counter() - started:.1f} с")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+# synthetic_data.py
+"""Синтетические данные для бенчмарков и нагрузочных тестов.
+
+Генерирует таблицы surveys, users, meal_ratings и meal_comments в той же
+форме, в какой их хранит Supabase, и клиент-заглушку, который отдаёт эти
+таблицы через тот же интерфейс запросов (table/select/gt/order/range/execute),
+что и настоящий клиент - без сети и без учётных данных.
+
+Таблицы можно сохранить в parquet для локального источника данных:
+
+    python synthetic_data.py --surveys 100000 --output data
+    DATA_SOURCE=snapshot DATA_SOURCE_PATH=data streamlit run app.py
+
+или отдать по HTTP локальной заменой PostgREST (JSON и CSV):
+
+    python synthetic_data.py --surveys 100000 --serve 54321
+    DATA_SOURCE=csv SUPABASE_URL=http://127.0.0.1:54321 streamlit run app.py
+"""
+import argparse
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from data_sources import to_records
+
+MEAL_TYPES = ['первое', 'второе', 'напиток']
+
+COMMENT_PHRASES = [
+    'Суп был холодный',
+    'Очень вкусно, спасибо!',
+    'Котлета пересолена',
+    'Мало порция',
+    'Компот слишком сладкий',
+    'Макароны переварены',
+    'Всё понравилось',
+    'Хлеб чёрствый',
+    'Каша без соли',
+    'Чай остывший',
+]
+
+def school_days(start_date, n_days):
+    """Учебные дни (пн-пт), начиная с start_date"""
+    days = pd.bdate_range(start=start_date, periods=n_days)
+    return days.normalize()
+
+def generate_users(n_users, rng, n_schools=1):
+    """Ученики с классами 5-11 и литерами А-Г в разных написаниях.
+    
+    Школы нумеруются с 64: при n_schools > 1 ученики делятся между ними поровну.
+    """
+    grades = rng.integers(5, 12, n_users)
+    letters = rng.choice(list('АБВГ'), n_users)
+    classes = pd.Series([f'{grade}{letter}' for grade, letter in zip(grades, letters)], dtype=object)
+    
+    # Как в реальных данных: латиница вместо кириллицы, строчные буквы, пробелы, пропуски
+    variant = rng.random(n_users)
+    classes[variant < 0.05] = classes[variant < 0.05].str.replace('А', 'A')
+    classes[(variant >= 0.05) & (variant < 0.08)] = classes[(variant >= 0.05) & (variant < 0.08)].str.lower()
+    classes[(variant >= 0.08) & (variant < 0.10)] = ' ' + classes[(variant >= 0.08) & (variant < 0.10)] + ' '
+    classes[variant >= 0.98] = None
+    
+    return pd.DataFrame({
+        'id': np.arange(1, n_users + 1, dtype='int64'),
+        'telegram_id': np.arange(100_000_001, 100_000_001 + n_users, dtype='int64'),
+        'class': classes,
+        # Для одной школы генератор случайных чисел не трогаем - данные прежние
+        'school_id': (64 + (rng.integers(0, n_schools, n_users) if n_schools > 1 else np.zeros(n_users, dtype='int64'))).astype(str)
+    })
+
+def generate_tables(n_surveys, seed=64, start_date='2023-09-01', comment_share=0.2, n_schools=1):
+    """Генерирует все четыре таблицы.
+    
+    n_surveys - число анкет; оценок блюд в 3 раза больше, пользователей
+    и учебных дней - пропорционально (до 10 учебных лет истории).
+    Возвращает {таблица: DataFrame}, строки отсортированы по id.
+    """
+    rng = np.random.default_rng(seed)
+    n_users = int(np.clip(n_surveys // 40, 50, 200_000))
+    n_days = int(np.clip(n_surveys // 60, 20, 1_700))
+    
+    users = generate_users(n_users, rng, n_schools)
+    days = school_days(start_date, n_days)
+    
+    # Активность по дням неравномерная: часть дней заметно "тише"
+    day_weights = rng.gamma(4.0, 1.0, n_days)
+    day_index = np.sort(rng.choice(n_days, n_surveys, p=day_weights / day_weights.sum()))
+    
+    # Оценки смещены к 4, в отдельные дни столовая готовит хуже
+    day_quality = rng.normal(0.0, 0.6, n_days)
+    overall = np.clip(np.rint(rng.normal(3.8, 1.0, n_surveys) + day_quality[day_index]), 1, 5).astype('int8')
+    
+    authors = rng.integers(0, n_users, n_surveys)
+    surveys = pd.DataFrame({
+        'id': np.arange(1, n_surveys + 1, dtype='int64'),
+        'telegram_id': users['telegram_id'].to_numpy()[authors],
+        'date': days[day_index],
+        'overall_satisfaction': overall,
+        'eats_at_school': rng.random(n_surveys) < 0.75,
+        'school_id': users['school_id'].to_numpy()[authors]
+    })
+    
+    # Три оценки блюд на анкету, близкие к общей оценке
+    n_ratings = n_surveys * len(MEAL_TYPES)
+    ratings = np.clip(np.repeat(overall, len(MEAL_TYPES)) + rng.integers(-1, 2, n_ratings), 1, 5)
+    meal_ratings = pd.DataFrame({
+        'id': np.arange(1, n_ratings + 1, dtype='int64'),
+        'survey_id': np.repeat(surveys['id'].to_numpy(), len(MEAL_TYPES)),
+        'meal_type': np.tile(MEAL_TYPES, n_surveys),
+        'rating': ratings.astype('int8')
+    })
+    
+    commented = np.flatnonzero(rng.random(n_surveys) < comment_share)
+    meal_comments = pd.DataFrame({
+        'id': np.arange(1, len(commented) + 1, dtype='int64'),
+        'survey_id': surveys['id'].to_numpy()[commented],
+        'meal_type': rng.choice(MEAL_TYPES, len(commented)),
+        'comment': rng.choice(COMMENT_PHRASES, len(commented))
+    })
+    
+    return {
+        'surveys': surveys,
+        'users': users,
+        'meal_ratings': meal_ratings,
+        'meal_comments': meal_comments
+    }
+
+# =============================================================================
+# КЛИЕНТ-ЗАГЛУШКА SUPABASE
+# =============================================================================
+class SyntheticResponse:
+    """Ответ в форме postgrest APIResponse: data - список словарей, count - число строк"""
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+class SyntheticQuery:
+    """Цепочка запроса поверх DataFrame с тем же интерфейсом, что у postgrest.
+    
+    Из встроенных ресурсов понимает только фильтр через родителя:
+    select("...,surveys!inner(school_id)").eq("surveys.school_id", ...).
+    """
+    def __init__(self, df, row_cap, tables=None):
+        self.df = df
+        self.tables = tables or {}
+        self.row_cap = row_cap
+        self.columns = None
+        self.with_count = False
+        self.filters = []
+        self.order_by = []
+        self.bounds = None
+    
+    def select(self, columns="*", count=None):
+        self.columns = None if columns == "*" else [c.strip() for c in columns.split(",")]
+        self.with_count = count is not None
+        return self
+    
+    def gt(self, column, value):
+        self.filters.append((column, 'gt', value))
+        return self
+    
+    def gte(self, column, value):
+        self.filters.append((column, 'gte', value))
+        return self
+    
+    def eq(self, column, value):
+        self.filters.append((column, 'eq', value))
+        return self
+    
+    def order(self, column, desc=False):
+        self.order_by.append((column, desc))
+        return self
+    
+    def range(self, start, end):
+        self.bounds = (start, end)
+        return self
+    
+    def page(self):
+        """(страница как DataFrame, общее число строк после фильтров)"""
+        df = self.df
+        for column, op, value in self.filters:
+            if '.' in column:
+                # Фильтр по колонке родителя (ключ связи - survey_id для surveys)
+                parent_name, parent_column = column.split('.', 1)
+                parent = self.tables[parent_name]
+                ids = parent.loc[parent[parent_column].astype(str) == str(value), 'id']
+                df = df[df[f"{parent_name.rstrip('s')}_id"].isin(ids)]
+            elif op == 'gt':
+                df = df[df[column] > value]
+            elif op == 'gte':
+                df = df[df[column] >= value]
+            else:
+                df = df[df[column] == value]
+        
+        if self.order_by and not (len(self.order_by) == 1 and df[self.order_by[0][0]].is_monotonic_increasing):
+            df = df.sort_values(
+                [column for column, _ in self.order_by],
+                ascending=[not desc for _, desc in self.order_by],
+                kind='stable'
+            )
+        
+        total = len(df)
+        start, end = self.bounds if self.bounds else (0, total - 1)
+        # Как PostgREST: не больше row_cap строк за запрос
+        page = df.iloc[start:min(end + 1, start + self.row_cap)]
+        if self.columns:
+            page = page[[c for c in self.columns if c in page.columns]]
+        return page, total
+    
+    def execute(self):
+        page, total = self.page()
+        return SyntheticResponse(to_records(page), total if self.with_count else None)
+
+class SyntheticSupabaseClient:
+    """Заглушка клиента Supabase, отдающая сгенерированные таблицы"""
+    def __init__(self, tables, row_cap=1000):
+        self.tables = tables
+        self.row_cap = row_cap
+    
+    def table(self, name):
+        return SyntheticQuery(self.tables[name], self.row_cap, self.tables)
+
+# =============================================================================
+# ЛОКАЛЬНАЯ ЗАМЕНА POSTGREST ПО HTTP
+# =============================================================================
+def to_postgres_csv(page):
+    """Страница в CSV так, как его пишет PostgREST: даты ISO, логические t/f, NULL - пусто"""
+    page = page.copy()
+    for column in page.columns:
+        if pd.api.types.is_datetime64_any_dtype(page[column]):
+            page[column] = page[column].dt.strftime('%Y-%m-%d')
+        elif pd.api.types.is_bool_dtype(page[column]):
+            page[column] = page[column].map({True: 't', False: 'f'})
+    return page.to_csv(index=False)
+
+class PostgrestHandler(BaseHTTPRequestHandler):
+    """GET /rest/v1/<таблица> с подмножеством синтаксиса PostgREST.
+    
+    Понимает select (в том числе родитель!inner(колонка)), фильтры
+    колонка=gt.|gte.|eq.значение и родитель.колонка=eq.значение, order,
+    заголовки Range, Prefer: count=exact и Accept: text/csv.
+    """
+    client = None  # SyntheticSupabaseClient, задаётся в serve_postgrest
+    
+    def do_GET(self):
+        url = urlsplit(self.path)
+        table = url.path.rsplit('/', 1)[-1]
+        if not url.path.startswith('/rest/v1/') or table not in self.client.tables:
+            self.send_error(404)
+            return
+        
+        query = self.client.table(table)
+        embedded = {}
+        for name, value in parse_qsl(url.query):
+            if name == 'select':
+                columns = []
+                for column in value.split(','):
+                    if '!inner(' in column:
+                        parent, inner = column.split('!inner(')
+                        embedded[parent] = inner.rstrip(')')
+                    else:
+                        columns.append(column)
+                query.select(','.join(columns), count='exact' if 'count=exact' in self.headers.get('Prefer', '') else None)
+            elif name == 'order':
+                for item in value.split(','):
+                    column, _, direction = item.partition('.')
+                    query.order(column, desc=direction == 'desc')
+            else:
+                op, _, operand = value.partition('.')
+                # Значения в адресе - строки; числовые колонки сравниваются с числом
+                df = self.client.tables[table]
+                if name in df.columns and pd.api.types.is_numeric_dtype(df[name]):
+                    operand = pd.to_numeric(operand)
+                getattr(query, op)(name, operand)
+        
+        start, end = 0, None
+        if self.headers.get('Range'):
+            first, _, last = self.headers['Range'].partition('-')
+            start, end = int(first), int(last) if last else None
+        query.range(start, end if end is not None else start + self.client.row_cap - 1)
+        page, total = query.page()
+        
+        # Встроенный родитель приходит отдельной колонкой с JSON его полей
+        for parent, column in embedded.items():
+            value = next((operand for field, op, operand in query.filters if field == f"{parent}.{column}"), None)
+            page = page.assign(**{parent: json.dumps({column: value}, ensure_ascii=False)})
+        
+        if 'text/csv' in self.headers.get('Accept', ''):
+            body, content_type = to_postgres_csv(page).encode('utf-8'), 'text/csv; charset=utf-8'
+        else:
+            body, content_type = json.dumps(to_records(page), ensure_ascii=False).encode('utf-8'), 'application/json'
+        
+        self.send_response(206 if start or len(page) < total else 200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        rows = f"{start}-{start + len(page) - 1}" if len(page) else '*'
+        self.send_header('Content-Range', f"{rows}/{total if query.with_count else '*'}")
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def serve_postgrest(tables, port=0, row_cap=1000):
+    """Поднимает локальную замену PostgREST в фоновом потоке.
+    
+    Возвращает сервер; адрес - http://127.0.0.1:<server.server_port>,
+    остановка - server.shutdown().
+    """
+    handler = type('Handler', (PostgrestHandler,), {'client': SyntheticSupabaseClient(tables, row_cap)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_tables(tables, path):
+    """Сохраняет таблицы в <path>/<таблица>.parquet (формат SnapshotSource)"""
+    os.makedirs(path, exist_ok=True)
+    for table, df in tables.items():
+        df.to_parquet(os.path.join(path, f"{table}.parquet"), index=False)
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические таблицы дашборда в parquet")
+    parser.add_argument('--surveys', type=int, default=100_000, help="Число анкет")
+    parser.add_argument('--seed', type=int, default=64)
+    parser.add_argument('--schools', type=int, default=1, help="Число школ (school_id с 64)")
+    parser.add_argument('--output', default='data', help="Папка для файлов таблиц")
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help="Не сохранять, а отдавать таблицы по HTTP как PostgREST на этом порту")
+    args = parser.parse_args()
+    
+    tables = generate_tables(args.surveys, seed=args.seed, n_schools=args.schools)
+    for table, df in tables.items():
+        print(f"{table}: {len(df)} строк")
+    if args.serve is not None:
+        server = serve_postgrest(tables, args.serve)
+        print(f"PostgREST: http://127.0.0.1:{server.server_port}/rest/v1/<таблица> (Ctrl+C - остановить)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+    write_tables(tables, args.output)
+
+if __name__ == "__main__":
+    main()